@@ -1,17 +1,18 @@
 #!/usr/bin/env python3
 """
-sudo apt-get install libapache2-mod-wsgi-py3
-sudo pip3 install pynetbox
+sudo apt-get install libapache2-mod-wsgi-py3 python3-flask
 """
 
+import os
 import sys
-import yaml
-import requests
+import hashlib
+import datetime
+import threading
+import urllib.parse
 import sqlite3
 
 from orderedattrdict import AttrDict
-import pynetbox
-from flask import Flask,jsonify
+from flask import Flask,json,request,abort,url_for
 
 sys.path.insert(0, "/opt")
 import abtools_control.sync_common as common
@@ -24,69 +25,288 @@ CONFIG_FILE="/etc/abtools/abtools_control.yaml"
 # ----- End of configuration items -----
 
 
-# Load configuration
-config = utils.load_config(CONFIG_FILE)
+# Loaded by create_app()
+config = None
 
 app = Flask(__name__)
 
+# Pre-serialized elements API responses, rebuilt when the sync generation changes
+snapshot = AttrDict(generation=None, last_modified=None, elements=None, hosts={})
+snapshot_lock = threading.Lock()
 
-def get_elements_db(elements, hostname=None):
+
+# Compact JSON, as jsonify() writes it when not in debug mode
+SEPARATORS = (",", ":")
+
+# Per-thread database connections
+db_local = threading.local()
+
+
+def get_db():
+    """
+    Return the read-only connection to the local database for this thread.
+    It is opened on first use and kept, so page cache and parsed schema
+    are reused between requests. With WAL, readers never wait for a sync
+    that is writing, each read transaction sees the last committed sync
+
+    A WAL reader creates the -wal and -shm files if no other connection
+    has them open, so the API user needs write access to the directory
+    of the database. If the database cannot be read, the request is
+    answered with 503 and the reason is logged
+    """
+    db = getattr(db_local, "db", None)
+    if db is None:
+        try:
+            db = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(config.sync_db),
+                                 uri=True, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA query_only=1")
+            db.execute("PRAGMA mmap_size=%d" % config.get("api", {}).get("mmap_size", 268435456))
+            db.execute("SELECT count(*) FROM sqlite_master").fetchone()  # Opens the WAL
+        except sqlite3.OperationalError as err:
+            if db is not None:
+                db.close()
+            msg = "Cannot read database %s: %s" % (config.sync_db, err)
+            if "readonly" in str(err):
+                msg += ", the API user needs write access to %s for the WAL files" % \
+                    os.path.dirname(os.path.abspath(config.sync_db))
+            print(msg, file=sys.stderr)
+            abort(503, msg)
+        db_local.db = db
+    return db
+
+
+def end_transaction(db):
+    """
+    End the read transaction, so the connection does not keep an old
+    version of the database
+    """
+    if db.in_transaction:
+        db.execute("ROLLBACK")
+
+
+# Query parameters filtering on an elements column
+FILTER_TEXT = ("_src", "manufacturer", "model", "platform", "role", "site_name")
+FILTER_BOOL = ("active", "monitor_icinga", "monitor_librenms", "backup_oxidized")
+
+
+def bool_arg(name, value):
     """
-    Read one or all elements from local database
+    Convert a query parameter to 0 or 1, raises ValueError if not a boolean
+    """
+    value = value.lower()
+    if value in ("1", "true", "yes"):
+        return 1
+    if value in ("0", "false", "no"):
+        return 0
+    raise ValueError("Parameter %s must be 0 or 1" % name)
+
+
+def parse_query(args=None):
+    """
+    Parse request query parameters, returns an AttrDict with
+      where, params  SQL conditions on the elements table, and their parameters
+      fields         element fields to return, None for all fields
+      interfaces     False if interfaces should not be read
+      limit          max number of elements, None for all
+    Parameters
+      <column>=value       filter, several values matches any of them
+      tag=value            element has tag, several tags must all match
+      fields=a,b,...       only return these fields
+      interfaces=0         do not return interfaces
+      limit=n, after=name,id  keyset pagination, elements are ordered on
+                           hostname and id, after is the last element of the
+                           previous page
+    Raises ValueError on unknown or invalid parameters
+    """
+    query = AttrDict(where=[], params=[], fields=None, interfaces=True, limit=None)
+    if args is None:
+        return query
+    for name in args:
+        values = args.getlist(name)
+        if name in FILTER_TEXT:
+            query.where.append("%s IN (%s)" % (name, ",".join("?" * len(values))))
+            query.params += values
+        elif name in FILTER_BOOL:
+            query.where.append("%s=?" % name)
+            query.params.append(bool_arg(name, values[-1]))
+        elif name == "tag":
+            for tag in values:
+                query.where.append("instr(','||tags||',',?)>0")
+                query.params.append(",%s," % tag)
+        elif name == "fields":
+            query.fields = [field for value in values for field in value.split(",") if field]
+            unknown = set(query.fields) - set(common.ELEMENT_COLUMNS) - {"interfaces"}
+            if unknown:
+                raise ValueError("Unknown fields %s" % ",".join(sorted(unknown)))
+            if "interfaces" not in query.fields:
+                query.interfaces = False
+        elif name == "interfaces":
+            if not bool_arg(name, values[-1]):
+                query.interfaces = False
+        elif name == "limit":
+            try:
+                query.limit = int(values[-1])
+            except ValueError:
+                query.limit = 0
+            if query.limit < 1:
+                raise ValueError("Parameter limit must be a positive integer")
+        elif name == "after":
+            # The same hostname can be stored by several sources
+            hostname, sep, elementid = values[-1].rpartition(",")
+            try:
+                elementid = int(elementid)
+            except ValueError:
+                raise ValueError("Parameter after must be hostname,id")
+            query.where.append("(hostname,id)>(?,?)")
+            query.params += [hostname, elementid]
+        else:
+            raise ValueError("Unknown parameter %s" % name)
+    return query
+
+
+def element_json(element, fields=None):
+    """
+    Return an element as a dict that can be serialized, with only fields if set
+    """
+    data = element.to_json()
+    if fields is None:
+        return data
+    return {field: data[field] for field in fields}
+
+
+def get_elements_db(elements, hostname=None, query=None):
+    """
+    Read one or all elements from local database, or the elements matching query
     Local database content is updated/synced from NetBox periodically by a separate program
+    If a hostname is stored by several sources, the last one is kept
+    Returns the number of rows read, and (hostname, id) of the last row or None
     """
-    db = sqlite3.connect(config.sync_db)
-    ce = db.cursor()
-    ce.row_factory = sqlite3.Row
-    ci = None
+    if query is None:
+        query = parse_query()
     if hostname:
-        ce.execute("SELECT * FROM elements WHERE hostname=?", (hostname,))
-    else:
-        ce.execute("SELECT * FROM elements")
-
-    for element_row in ce:
-        element = common.Element()
-        element.hostname = element_row["hostname"]
-        element.manufacturer = element_row["manufacturer"]
-        element.model = element_row["model"]
-        element.comments = element_row["comments"]
-        element.tags = common.commastr_to_list(element_row["tags"], add_domain=False)
-        element.parents = common.commastr_to_list(element_row["parents"], add_domain=True)
-        element.role = element_row["role"]
-        element.site_name = element_row["site_name"]
-        element.platform = element_row["platform"]
-        element.ipv4_addr = element_row["ipv4_addr"]
-        element.ipv6_addr = element_row["ipv6_addr"]
-        element.active = element_row["active"] == 1  # to boolean
-
-        element.alarm_timeperiod = element_row["alarm_timeperiod"]
-        element.alarm_destination = common.commastr_to_list(element_row["alarm_destination"], add_domain=False)
-        element.connection_method = element_row["connection_method"]
-        element.monitor_icinga = element_row["monitor_icinga"] == 1  # to boolean
-        element.monitor_librenms = element_row["monitor_librenms"] == 1  # to boolean 
-        element.backup_oxidized = element_row["backup_oxidized"] == 1  # to boolean
-
-        # Get all element interfaces
-        interfaces = AttrDict()
-        ci = db.cursor()
-        ci.row_factory = sqlite3.Row
-        ci.execute("SELECT * FROM interfaces WHERE elementid=?", (element_row["id"],))
-        for interface_row in ci:
-            interface = common.Interface()
-            interface.name = interface_row["name"]
-            interface.role = interface_row["role"]
-            interface.ipv4_prefix = interface_row["ipv4_prefix"]
-            interface.ipv6_prefix = interface_row["ipv6_prefix"]
-            interface.active = interface_row["active"] == 1  # to boolean
-            interfaces[interface.name] = interface
-
-        element.interfaces = interfaces
-        elements[element.hostname] = element
-
-    if ci:
-        ci.close()
-    ce.close()
-    db.close()
+        query = AttrDict(query, where=query.where + ["hostname=?"], params=query.params + [hostname])
+    db = get_db()
+    count = 0
+    last = None
+    try:
+        db.execute("BEGIN")
+        for elementid, element in common.read_elements(db, query.where, query.params, query.limit,
+                                                       query.interfaces, domain=config.default_domain,
+                                                       with_id=True):
+            elements[element.hostname] = element
+            count += 1
+            last = (element.hostname, elementid)
+    finally:
+        end_transaction(db)
+    return count, last
+
+
+def stream_elements_db(query=None, chunk_size=65536):
+    """
+    Generator, yields the JSON object with all elements matching query in
+    chunks of about chunk_size characters, serializing one element at a
+    time straight from the database cursors
+    If a hostname is stored by several sources, only the last one is
+    written, as in a dict, so the object has unique keys
+    The read transaction starts when the first chunk is requested
+    """
+    if query is None:
+        query = parse_query()
+    db = get_db()
+    try:
+        db.execute("BEGIN")
+        out = ["{"]
+        size = 0
+        separator = ""
+        previous = None
+        for element in common.read_elements(db, query.where, query.params, query.limit, query.interfaces,
+                                            domain=config.default_domain):
+            if previous is not None and previous.hostname != element.hostname:
+                # app.json, the generator runs outside the application context
+                chunk = "%s%s:%s" % (separator, app.json.dumps(previous.hostname),
+                                     app.json.dumps(element_json(previous, query.fields), separators=SEPARATORS))
+                separator = ","
+                out.append(chunk)
+                size += len(chunk)
+                if size >= chunk_size:
+                    yield "".join(out)
+                    out = []
+                    size = 0
+            previous = element
+        if previous is not None:
+            out.append("%s%s:%s" % (separator, app.json.dumps(previous.hostname),
+                                    app.json.dumps(element_json(previous, query.fields), separators=SEPARATORS)))
+        out.append("}\n")
+        yield "".join(out)
+    finally:
+        end_transaction(db)
+
+
+def get_generation_db():
+    """
+    Return the sync generation of the local database, as a tuple of (_src, generation),
+    and the time of the last committed sync
+    The sync scripts bumps the generation each time they commit new data
+    Returns (None, None) if the database does not have any generation information
+    """
+    db = get_db()
+    try:
+        rows = db.execute("SELECT _src,generation,last_sync FROM sync_meta ORDER BY _src").fetchall()
+    except sqlite3.OperationalError:
+        rows = None   # No sync_meta table, database created by an older sync script
+    if rows:
+        generation = tuple((row[0], row[1]) for row in rows)
+        last_sync = max(row[2] for row in rows)
+        return generation, datetime.datetime.fromtimestamp(last_sync, datetime.timezone.utc)
+    return None, None
+
+
+def serialize(data):
+    """
+    Serialize data to JSON, returns an AttrDict with the body and a strong ETag
+    """
+    body = json.dumps(data, separators=SEPARATORS) + "\n"
+    return AttrDict(body=body, etag=hashlib.sha1(body.encode()).hexdigest())
+
+
+def get_snapshot():
+    """
+    Return a snapshot with the serialized response for all elements, and
+    for each hostname. The snapshot is rebuilt only when the sync generation
+    has changed since the snapshot was created
+    """
+    global snapshot
+
+    generation, last_modified = get_generation_db()
+    with snapshot_lock:
+        if generation is None or generation != snapshot.generation:
+            elements = AttrDict()
+            get_elements_db(elements)
+            elements = {hostname: element.to_json() for hostname, element in elements.items()}
+            hosts = {}
+            for hostname, element in elements.items():
+                hosts[hostname] = serialize({hostname: element})
+            snapshot = AttrDict(
+                generation=generation,
+                last_modified=last_modified,
+                elements=serialize(elements),
+                hosts=hosts,
+            )
+        return snapshot
+
+
+def create_app():
+    """
+    Application factory for WSGI servers, for example
+        gunicorn --workers 2 --threads 8 'api:create_app()'
+        waitress-serve --threads 8 --call api:create_app
+    Loads the configuration. Database connections are opened per thread on
+    first use, so the app can be created before the server forks its workers
+    """
+    global config
+    config = common.load_config(CONFIG_FILE, utils.load_config)
+    return app
 
 
 @app.route("/")
@@ -100,8 +320,57 @@ def get_elements(hostname=None):
     if hostname and "." not in hostname:
         hostname += "." + config.default_domain
     print(hostname)    
-    elements = AttrDict()
+    try:
+        query = parse_query(request.args)
+    except ValueError as err:
+        abort(400, str(err))
+    if request.args or not config.get("api", {}).get("snapshot", False):
+        return get_elements_stream(hostname, query)
+
+    current = get_snapshot()
+    if hostname:
+        data = current.hosts.get(hostname)
+        if data is None:
+            data = serialize({})
+    else:
+        data = current.elements
 
-    get_elements_db(elements, hostname=hostname)
+    # Answers 304 Not Modified if the client already has this version
+    response = app.response_class(data.body, mimetype="application/json")
+    response.set_etag(data.etag)
+    if current.last_modified:
+        response.last_modified = current.last_modified
+    return response.make_conditional(request)
 
-    return jsonify(elements)
+
+def get_elements_stream(hostname=None, query=None):
+    """
+    Answer without the snapshot. One element, or a page of elements, is
+    read from the database. Otherwise all matching elements are streamed
+    as they are read
+
+    A full page gets a Link header to the next page
+    The ETag of the streamed response is derived from the sync generation
+    and the query, so conditional requests are answered before anything is read
+    """
+    if query is None:
+        query = parse_query()
+    generation, last_modified = get_generation_db()
+    if hostname or query.limit:
+        elements = AttrDict()
+        count, last = get_elements_db(elements, hostname=hostname, query=query)
+        data = serialize({hostname: element_json(element, query.fields) for hostname, element in elements.items()})
+        response = app.response_class(data.body, mimetype="application/json")
+        response.set_etag(data.etag)
+        if query.limit and count == query.limit:
+            args = request.args.to_dict(flat=False)
+            args["after"] = "%s,%d" % last
+            response.headers["Link"] = '<%s>; rel="next"' % url_for("get_elements", **args)
+    else:
+        response = app.response_class(stream_elements_db(query), mimetype="application/json")
+        if generation is not None:
+            etag = repr(generation) + request.query_string.decode()
+            response.set_etag(hashlib.sha1(etag.encode()).hexdigest())
+    if last_modified:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
@@ -1,6 +1,29 @@
 #!/usr/bin/env python3
+"""
+Run the elements API
+
+Default is the flask development server. With --production the API is
+served by waitress, with a pool of threads
+
+dependencies, for --production:
+    sudo pip3 install waitress
+"""
+import argparse
+
 import api
 
 if __name__ == '__main__':
-	print("Starting development server")
-	api.app.run(host='0.0.0.0', debug=True, threaded=False, processes=1)
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--production", action="store_true", help="Serve with waitress")
+	parser.add_argument("--host", default="0.0.0.0")
+	parser.add_argument("--port", type=int, default=5000)
+	parser.add_argument("--threads", type=int, default=8, help="Number of waitress threads")
+	args = parser.parse_args()
+
+	if args.production:
+		import waitress
+		print("Starting waitress server")
+		waitress.serve(api.create_app(), host=args.host, port=args.port, threads=args.threads)
+	else:
+		print("Starting development server")
+		api.create_app().run(host=args.host, port=args.port, debug=True, threaded=False, processes=1)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Parse router/switch configurations, extracting all interfaces and
+their IP addresses
+
+Each vendor syntax is handled by a Grammar. A Grammar is compiled to a
+few regular expressions, and scans the whole configuration text with
+them, instead of looping over the config lines in python
+"""
+
+import re
+import ipaddress
+from collections import namedtuple
+
+# Increment when a grammar changes, invalidates cached parse results
+PARSER_VERSION = 1
+
+# One address found in a configuration
+# family is 4 or 6, vrf is "" for the global routing table
+Address = namedtuple("Address", "ifname vrf family addr secondary")
+
+OCTET = r"(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)"
+IPV4 = r"%s(?:\.%s){3}" % (OCTET, OCTET)
+IPV6 = r"[0-9A-Fa-f:]*:[0-9A-Fa-f:.]*"
+
+
+def ifname_to_dnsname(hostname, ifname):
+    hostname = hostname.split(".")[0]
+    name = "%s.%s" % (hostname, ifname)
+    name = name.replace("/", "-").replace(" ", "")
+    return name
+
+
+def valid_ipv6(addr):
+    try:
+        ipaddress.IPv6Address(addr)
+        return True
+    except ipaddress.AddressValueError:
+        return False
+
+
+class Grammar:
+    """
+    Base class for configurations with indented interface blocks
+
+        interface <name>
+         <interface config>
+
+    A block ends at the first line that is not indented
+    Subclasses sets the regex for addresses and VRF inside a block
+    """
+    name = ""
+
+    re_block = re.compile(r"^interface[ \t]+(\S[^\n]*?)[ \t]*\n((?:[ \t][^\n]*(?:\n|$))*)", re.M)
+
+    # Groups: vrf, addr4, secondary4, addr6. Add more alternatives if needed
+    re_line = None
+
+    def parse(self, conf):
+        """
+        Returns a list of Address, in configuration order
+        """
+        addresses = []
+        for block in self.re_block.finditer(conf):
+            ifname = block.group(1).lower()
+            vrf = ""
+            primary = {}    # key is family, True if primary address found
+            for m in self.re_line.finditer(block.group(2)):
+                if m.group("vrf"):
+                    vrf = m.group("vrf")
+                elif m.group("addr4"):
+                    secondary = bool(m.group("secondary4")) or 4 in primary
+                    primary[4] = True
+                    addresses.append(Address(ifname, vrf, 4, m.group("addr4"), secondary))
+                elif m.group("addr6"):
+                    addr = m.group("addr6")
+                    if not valid_ipv6(addr):
+                        print("Error: interface '%s', ipv6_addr '%s' incorrect" % (ifname, addr))
+                        continue
+                    secondary = 6 in primary
+                    primary[6] = True
+                    addresses.append(Address(ifname, vrf, 6, addr, secondary))
+        return addresses
+
+
+class Grammar_IOS(Grammar):
+    """
+    Cisco IOS and IOS-XE
+
+        interface GigabitEthernet0/1
+         vrf forwarding CUSTOMER
+         ip address 10.0.0.1 255.255.255.0
+         ip address 10.0.1.1 255.255.255.0 secondary
+         ipv6 address 2001:DB8::1/64
+
+    Also accepts "ipv4 address", so IOS-XR addresses are found when the
+    platform is unknown
+    """
+    name = "ios"
+
+    re_line = re.compile(
+        r"^[ \t]+(?:ip[ \t]+)?vrf[ \t]+forwarding[ \t]+(?P<vrf>\S+)"
+        r"|^[ \t]+ip(?:v4)?[ \t]+address[ \t]+(?P<addr4>%s)[ \t]+%s(?P<secondary4>[ \t]+secondary)?"
+        r"|^[ \t]+ipv6[ \t]+address[ \t]+(?P<addr6>%s)/\d+" % (IPV4, IPV4, IPV6),
+        re.M)
+
+
+class Grammar_IOS_XR(Grammar):
+    """
+    Cisco IOS-XR
+
+        interface GigabitEthernet0/0/0/0
+         vrf CUSTOMER
+         ipv4 address 10.0.0.1 255.255.255.0
+         ipv4 address 10.0.1.1 255.255.255.0 secondary
+         ipv6 address 2001:db8::1/64
+    """
+    name = "iosxr"
+
+    re_line = re.compile(
+        r"^[ \t]+vrf[ \t]+(?P<vrf>\S+)"
+        r"|^[ \t]+ipv4[ \t]+address[ \t]+(?P<addr4>%s)[ \t]+%s(?P<secondary4>[ \t]+secondary)?"
+        r"|^[ \t]+ipv6[ \t]+address[ \t]+(?P<addr6>%s)/\d+" % (IPV4, IPV4, IPV6),
+        re.M)
+
+
+class Grammar_VRP(Grammar):
+    """
+    Huawei VRP
+
+        interface GigabitEthernet0/0/1
+         ip binding vpn-instance CUSTOMER
+         ip address 10.0.0.1 255.255.255.0
+         ip address 10.0.1.1 255.255.255.0 sub
+         ipv6 address 2001:DB8::1/64
+        #
+    """
+    name = "vrp"
+
+    re_line = re.compile(
+        r"^[ \t]+ip[ \t]+binding[ \t]+vpn-instance[ \t]+(?P<vrf>\S+)"
+        r"|^[ \t]+ip[ \t]+address[ \t]+(?P<addr4>%s)[ \t]+\S+(?P<secondary4>[ \t]+sub)?"
+        r"|^[ \t]+ipv6[ \t]+address[ \t]+(?P<addr6>%s)/\d+" % (IPV4, IPV6),
+        re.M)
+
+
+class Grammar_Junos(Grammar):
+    """
+    Juniper Junos, set-style configuration (show configuration | display set)
+
+        set interfaces ge-0/0/0 unit 0 family inet address 10.0.0.1/30
+        set interfaces ge-0/0/0 unit 0 family inet6 address 2001:db8::1/64
+        set routing-instances CUSTOMER interface ge-0/0/0.0
+
+    Interface name is <interface>.<unit>. The first address of a family on
+    a unit is the primary, unless another address is marked primary
+    """
+    name = "junos"
+
+    re_address = re.compile(
+        r"^set[ \t]+interfaces[ \t]+(\S+)[ \t]+unit[ \t]+(\d+)[ \t]+family[ \t]+"
+        r"(?:inet[ \t]+address[ \t]+(%s)/\d+|inet6[ \t]+address[ \t]+(%s)/\d+)([ \t]+primary)?" % (IPV4, IPV6),
+        re.M)
+    re_vrf = re.compile(r"^set[ \t]+routing-instances[ \t]+(\S+)[ \t]+interface[ \t]+(\S+)", re.M)
+
+    def parse(self, conf):
+        vrfs = {}
+        for m in self.re_vrf.finditer(conf):
+            vrfs[m.group(2).lower()] = m.group(1)
+
+        addresses = []
+        primary = {}    # key is (ifname, family), value is index in addresses
+        for m in self.re_address.finditer(conf):
+            ifname = "%s.%s" % (m.group(1).lower(), m.group(2))
+            if m.group(3):
+                family, addr = 4, m.group(3)
+            else:
+                family, addr = 6, m.group(4)
+                if not valid_ipv6(addr):
+                    print("Error: interface '%s', ipv6_addr '%s' incorrect" % (ifname, addr))
+                    continue
+            key = (ifname, family)
+            if key not in primary:
+                primary[key] = len(addresses)
+                secondary = False
+            elif m.group(5):
+                # Explicit primary, demote the previous primary
+                ix = primary[key]
+                addresses[ix] = addresses[ix]._replace(secondary=True)
+                primary[key] = len(addresses)
+                secondary = False
+            else:
+                secondary = True
+            addresses.append(Address(ifname, vrfs.get(ifname, ""), family, addr, secondary))
+
+        # Primary addresses first
+        addresses.sort(key=lambda a: a.secondary)
+        return addresses
+
+
+GRAMMARS = {
+    "ios": Grammar_IOS(),
+    "iosxr": Grammar_IOS_XR(),
+    "vrp": Grammar_VRP(),
+    "junos": Grammar_Junos(),
+}
+
+# Alternative platform and manufacturer names, lowercase with only a-z and 0-9
+GRAMMAR_ALIASES = {
+    "cisco": "ios",
+    "iosxe": "ios",
+    "ciscoios": "ios",
+    "ciscoiosxe": "ios",
+    "ciscoxr": "iosxr",
+    "ciscoiosxr": "iosxr",
+    "xr": "iosxr",
+    "huawei": "vrp",
+    "huaweivrp": "vrp",
+    "juniper": "junos",
+    "juniperjunos": "junos",
+}
+
+# Vendor prefixes. "Cisco IOS-XR" is also tried as "IOS-XR", and
+# "Juniper Networks" as "Juniper"
+GRAMMAR_VENDORS = ("cisco", "huawei", "juniper")
+
+
+def get_grammar(platform="", manufacturer=""):
+    """
+    Return the grammar for an element, selected by platform, then by
+    manufacturer. Default is IOS
+    """
+    for name in (platform, manufacturer):
+        if not name:
+            continue
+        name = re.sub(r"[^a-z0-9]", "", name.lower())
+        names = [name]
+        for vendor in GRAMMAR_VENDORS:
+            if name.startswith(vendor) and name != vendor:
+                names += [name[len(vendor):], vendor]
+        for name in names:
+            name = GRAMMAR_ALIASES.get(name, name)
+            if name in GRAMMARS:
+                return GRAMMARS[name]
+    return GRAMMARS["ios"]
+
+
+def parse_records(hostname, conf, platform="", manufacturer="", secondary=False):
+    """
+    Parse a configuration, returns a list of (name, type, value, vrf)
+    tuples, only the first tuple for a name is included
+    Takes and returns plain data, so it can run in a worker process
+
+    Secondary addresses are only added if secondary is True, they get
+    the name of the interface with a -sec<n> suffix
+    """
+    grammar = get_grammar(platform, manufacturer)
+    result = []
+    names = set()
+    count = {}  # key is interface name, number of secondary addresses
+    for address in grammar.parse(conf):
+        # Shorten interface name if needed, and replace forward slash
+        name = ifname_to_dnsname(hostname, address.ifname)
+        if address.secondary:
+            if not secondary:
+                continue
+            count[name] = count.get(name, 0) + 1
+            name = "%s-sec%d" % (name, count[name])
+        if name in names:
+            continue
+        names.add(name)
+        if address.family == 4:
+            result.append((name, "A", address.addr, address.vrf))
+        else:
+            result.append((name, "AAAA", address.addr, address.vrf))
+    return result
+
+
+class Record:
+    """
+    One DNS record. host is True for an element management address
+    vrf is the VRF of an interface address, "" for the global routing table
+    """
+    __slots__ = ("hostname", "type", "value", "host", "vrf")
+
+    def __init__(self, hostname, rtype, value, host=False, vrf=""):
+        self.hostname = hostname
+        self.type = rtype
+        self.value = value
+        self.host = host
+        self.vrf = vrf
+
+    def __repr__(self):
+        return "Record(%r, %r, %r, host=%r)" % (self.hostname, self.type, self.value, self.host)
+
+    def address_key(self):
+        """
+        Return (type, address) with the address in canonical form, so
+        differently written IPv6 addresses compare equal
+        """
+        if self.type == "AAAA":
+            return (self.type, ipaddress.IPv6Address(self.value).compressed)
+        return (self.type, self.value)
+
+
+def reverse_rank(record):
+    """
+    Preference for owning the reverse entry of an address, lowest wins
+    """
+    return (not record.host, record.vrf != "")
+
+
+class Record_Store:
+    """
+    DNS records in insertion order, with one record per name
+
+    Indexes
+      by_name        name -> record
+      reverse_owner  (type, address) -> record owning the reverse (PTR) entry
+    The reverse owner is tracked as records are added; the first host
+    record, else the first record in the global routing table, else the
+    first record. Addresses in a VRF can be reused in other VRFs, so they
+    only get the PTR entry if no global record has the address
+    """
+
+    def __init__(self):
+        self.by_name = {}
+        self.reverse_owner = {}
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def get(self, name, default=None):
+        return self.by_name.get(name, default)
+
+    def values(self):
+        return self.by_name.values()
+
+    def add(self, record):
+        """
+        Add a record, returns False if a record with the name already exist
+        """
+        if record.hostname in self.by_name:
+            return False
+        self.by_name[record.hostname] = record
+        key = record.address_key()
+        owner = self.reverse_owner.get(key)
+        if owner is None or reverse_rank(record) < reverse_rank(owner):
+            self.reverse_owner[key] = record
+        return True
+
+    def has_reverse(self, record):
+        return self.reverse_owner[record.address_key()] is record
+
+    def partition(self):
+        """
+        Split the records in one pass into the dnsmgr sections
+          hosts    management addresses, forward and reverse
+          forward  forward only, another record owns the reverse entry
+          reverse  interface addresses, forward and reverse
+        Returns (hosts, forward, reverse), lists of records
+        """
+        hosts, forward, reverse = [], [], []
+        owner = self.reverse_owner
+        for record in self.by_name.values():
+            if owner[record.address_key()] is not record:
+                forward.append(record)
+            elif record.host:
+                hosts.append(record)
+            else:
+                reverse.append(record)
+        return hosts, forward, reverse
+
+
+def add_records(records, tuples):
+    """
+    Add (name, type, value, vrf) tuples to records, if name does not exist
+    """
+    for name, rtype, value, vrf in tuples:
+        records.add(Record(name, rtype, value, vrf=vrf))
+    return records
+
+
+def parser_version(secondary=False):
+    """
+    Return a string identifying the parse results of parse_records() with
+    these options, for caching
+    """
+    return "%d-%d" % (PARSER_VERSION, secondary)
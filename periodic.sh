@@ -3,17 +3,10 @@
 
 cd /opt/abtools_control
 
-echo ###########################################################################
-echo ! Get all elements, IP addresses from BECS, store in local db
-echo ###########################################################################
-./sync_becs_to_db.py
-
-echo ###########################################################################
-echo ! Get all elements, IP addresses from NetBox, store in local db
-echo ###########################################################################
-./sync_netbox_to_db.py
+# The API (www-data) shares the database -wal and -shm files
+umask 002
 
 echo ###########################################################################
-echo !  Update DNS
+echo ! Get all elements from BECS and NetBox, store in local db, update DNS
 echo ###########################################################################
-./sync_elements_to_dns.py
+./sync_all.py
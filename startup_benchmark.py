@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Measure the startup (import) time of the sync scripts and the API
+
+Each module is imported in a new interpreter with python3 -X importtime,
+repeated a number of times, and the fastest cumulative import time is
+reported, with the slowest modules it imports.
+Results can be saved, and later runs compared against them, to track
+the startup time
+
+    ./startup_benchmark.py
+    ./startup_benchmark.py --save startup.json
+    ./startup_benchmark.py --compare startup.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = [
+    "sync_common",
+    "config_parser",
+    "sync_becs_to_db",
+    "sync_netbox_to_db",
+    "sync_elements_to_dns",
+    "sync_all",
+    "api",
+]
+
+
+def import_times(module):
+    """
+    Import module in a new interpreter
+    Returns the cumulative import time of module in microseconds, and a dict
+    with the modules it imports directly, value is their cumulative import
+    time. None if the import failed
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root, os.path.join(root, "api"), env.get("PYTHONPATH", "")])
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                       env=env, cwd=root, capture_output=True, text=True)
+    if p.returncode:
+        print("Error: import %s failed" % module)
+        print(p.stderr.strip().splitlines()[-1])
+        return None
+
+    # import time: self [us] | cumulative | imported package
+    # A module is listed after the modules it imports, which are indented
+    children = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            self_us, cumulative, name = line[12:].split("|")
+            cumulative = int(cumulative)
+        except ValueError:
+            continue    # Header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 0:
+            if name == module:
+                return cumulative, children
+            children = {}
+        elif depth == 1:
+            children[name] = cumulative
+    return None
+
+
+def measure(module, repeat):
+    """
+    Returns the fastest of repeat runs, see import_times()
+    """
+    best = None
+    for i in range(repeat):
+        result = import_times(module)
+        if result is None:
+            return None
+        if best is None or result[0] < best[0]:
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per module")
+    parser.add_argument("--top", type=int, default=5, help="Slowest imported modules to show")
+    parser.add_argument("--save", help="Save results to this JSON file")
+    parser.add_argument("--compare", help="Compare with results in this JSON file")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for module in args.modules:
+        result = measure(module, args.repeat)
+        if result is None:
+            continue
+        total, children = result
+        results[module] = total
+        line = "%-22s %8.1f ms" % (module, total / 1000)
+        if module in baseline:
+            line += "   was %8.1f ms, %+6.1f ms" % (baseline[module] / 1000, (total - baseline[module]) / 1000)
+        print(line)
+        slowest = sorted((t, name) for name, t in children.items())
+        for t, name in reversed(slowest[-args.top:]):
+            print("    %-18s %8.1f ms" % (name, t / 1000))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Run all syncs, replaces the separate scripts in periodic.sh
+
+- Sync elements from BECS and NetBox to the local database, concurrently
+- Create DNS records, for the elements read directly from the local
+  database instead of through the elements API
+
+A lock file prevents overlapping runs. The time of each stage is printed
+at the end
+
+With --daemon, the syncs are run forever, each source on its own interval.
+DNS is only updated when a sync has changed the local database
+"""
+
+import sys
+import time
+import fcntl
+import random
+import signal
+import threading
+import argparse
+import concurrent.futures
+
+from orderedattrdict import AttrDict
+
+import sync_common as common
+import sync_becs_to_db
+import sync_netbox_to_db
+import sync_elements_to_dns
+
+sys.path.insert(0, "/opt")
+import ablib.utils as utils
+
+# ----- Start of configuration items ----------------------------------------
+
+CONFIG_FILE="/etc/abtools/abtools_control.yaml"
+
+# ----- End of configuration items ------------------------------------------
+
+config = None
+
+
+def get_lock(filename):
+    """
+    Take an exclusive lock on filename. Returns the open file, or None if
+    another run holds the lock. The lock is released when the process exits
+    """
+    f = open(filename, "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def timed(timings, name, func, *args, **kwargs):
+    """
+    Call func, and save the time it took in timings[name]
+    """
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[name] = time.time() - start
+
+
+def sync_sources(timings, incremental=False):
+    """
+    Sync BECS and NetBox concurrently. A failing source is reported, the
+    other source and the DNS stage still runs
+    """
+    print("----- Sync elements from BECS and NetBox -----")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {
+            executor.submit(timed, timings, "becs", sync_becs_to_db.main): "becs",
+            executor.submit(timed, timings, "netbox", sync_netbox_to_db.sync, incremental=incremental): "netbox",
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                print("Error: sync from %s failed" % futures[future])
+                utils.send_traceback()
+
+
+class Task:
+    """
+    A periodic task in the daemon. Runs every interval seconds, with random
+    jitter (fraction of the delay). After a failure it is retried after
+    retry seconds, doubling for each consecutive failure up to max_backoff
+    """
+
+    def __init__(self, name, func, interval, settings, first_run=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = first_run
+        self.failures = 0
+        self.jitter = settings.get("jitter", 0.1)
+        self.retry = settings.get("retry", 60)
+        self.max_backoff = settings.get("max_backoff", 3600)
+
+    def run(self):
+        """
+        Run the task and schedule the next run
+        Returns (ok, value returned by func)
+        """
+        print()
+        print("----- Daemon: %s -----" % self.name)
+        start = time.time()
+        try:
+            result = self.func()
+        except Exception:
+            self.failures += 1
+            print("Error: %s failed, %d consecutive failures" % (self.name, self.failures))
+            if self.failures == 1:
+                utils.send_traceback()
+            delay = min(self.retry * 2 ** (self.failures - 1), self.max_backoff)
+            ok, result = False, None
+        else:
+            self.failures = 0
+            delay = self.interval
+            ok = True
+        self.next_run = time.time() + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        print("----- Daemon: %s done in %.1f s, next run in %.0f s -----" % (
+            self.name, time.time() - start, self.next_run - time.time()))
+        return ok, result
+
+
+class Becs_Client:
+    """
+    Keeps one BECS session between syncs, a new session is created after an error
+    """
+
+    def __init__(self):
+        self.becs = None
+
+    def sync(self):
+        if self.becs is None:
+            sync_becs_to_db.init_config()
+            self.becs = sync_becs_to_db.get_becs()
+        try:
+            return sync_becs_to_db.store_elements_in_db(self.becs)
+        except Exception:
+            self.becs = None
+            raise
+
+
+def update_dns():
+    global config
+    config = common.load_config(CONFIG_FILE, utils.load_config)     # Reloaded if edited
+    elements = common.get_elements(config.sync_db, domain=config.default_domain)
+    sync_elements_to_dns.sync(elements)
+
+
+def run_daemon():
+    """
+    Run the source syncs on their own intervals, and DNS when a source sync
+    has changed the database. DNS runs at most every daemon.dns_interval
+    seconds, so changes from several syncs are handled in one DNS run
+    NetBox is synced incremental, with a full sync every netbox_full_interval
+    Stops on SIGTERM or SIGINT, after the running task
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    # Print progress as it happens when output is a log, not a terminal
+    sys.stdout.reconfigure(line_buffering=True)
+
+    now = time.time()
+    settings = config.get("daemon") or AttrDict()
+    becs = Becs_Client()
+    netbox_interval = settings.get("netbox_interval", 300)
+    tasks = [
+        Task("becs", becs.sync, settings.get("becs_interval", 900), settings),
+        Task("netbox full", lambda: sync_netbox_to_db.sync(),
+             settings.get("netbox_full_interval", 86400), settings),
+        Task("netbox incremental", lambda: sync_netbox_to_db.sync(incremental=True),
+             netbox_interval, settings, first_run=now + netbox_interval),
+    ]
+    dns = Task("dns", update_dns, settings.get("dns_interval", 60), settings)
+    dns_pending = True     # A previous run may have stopped before DNS was updated
+
+    while not stop.is_set():
+        for task in tasks:
+            if task.next_run <= time.time() and not stop.is_set():
+                ok, changed = task.run()
+                if ok and changed:
+                    dns_pending = True
+        if dns_pending and dns.next_run <= time.time() and not stop.is_set():
+            ok, result = dns.run()
+            if ok:
+                dns_pending = False
+
+        next_run = min(task.next_run for task in tasks)
+        if dns_pending:
+            next_run = min(next_run, dns.next_run)
+        stop.wait(max(next_run - time.time(), 0))
+    print("Daemon stopped")
+
+
+def main():
+    global config
+    config = common.load_config(CONFIG_FILE, utils.load_config)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Only fetch NetBox elements changed since last sync")
+    parser.add_argument("--no-dns",
+                        action="store_true",
+                        help="Do not update DNS")
+    parser.add_argument("--daemon",
+                        action="store_true",
+                        help="Run syncs forever, on the intervals in config daemon")
+    args = parser.parse_args()
+
+    lock = get_lock(config.get("sync_lock_file", "/var/lock/abtools_sync.lock"))
+    if lock is None:
+        print("Another sync is running, exiting")
+        return
+
+    if args.daemon:
+        run_daemon()
+        return
+
+    start = time.time()
+    timings = AttrDict()
+    sync_sources(timings, incremental=args.incremental)
+
+    if not args.no_dns:
+        print()
+        print("----- Read elements from local database -----")
+        elements = timed(timings, "read_db", common.get_elements, config.sync_db,
+                         domain=config.default_domain)
+        timed(timings, "dns", sync_elements_to_dns.sync, elements)
+    timings.total = time.time() - start
+
+    print()
+    print("----- Timings -----")
+    for name, seconds in timings.items():
+        print("   %-10s : %6.1f s" % (name, seconds))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except:
+        # Error in script, send traceback to developer
+        utils.send_traceback()
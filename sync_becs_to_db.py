@@ -2,8 +2,11 @@
 """
 Fetch all elements of type iBOS from BECS
 
-For each element, fetch all interfaces and their ipv4 addresses.
-Write this to a sqlite3 database, protected by a transaction
+For each element, fetch all interfaces and their ipv4 addresses. Interfaces
+are fetched with one objectTreeFind from the root, or per element in
+parallel if becs.bulk_interfaces is false.
+Write this to a sqlite3 database, protected by a transaction. Only changed
+rows are written
 Columns in database uses the netbox names
 
 dependencies:
@@ -14,14 +17,14 @@ import sys
 import time
 import argparse
 import sqlite3
+import concurrent.futures
 
-import zeep
+from orderedattrdict import AttrDict
 
 import sync_common as common
 
 sys.path.insert(0, "/opt")
 import ablib.utils as utils
-from ablib.becs import BECS
 
 # ----- Start of configuration items ----------------------------------------
 
@@ -29,26 +32,115 @@ CONFIG_FILE="/etc/abtools/abtools_control.yaml"
 
 # ----- End of configuration items ------------------------------------------
 
-# Load configuration
-config = utils.load_config(CONFIG_FILE)
+config = None
+
+
+def init_config():
+    """
+    Load configuration, called by the entry points
+    """
+    global config
+    config = common.load_config(CONFIG_FILE, utils.load_config)
+
+
+def get_becs():
+    """
+    Return a logged in BECS session
+    """
+    from ablib.becs import BECS     # zeep is slow to import, only when needed
+    return BECS(config.becs.eapi, config.becs.username, config.becs.password)
+
+
+def get_interfaces(becs, elements, workers=8):
+    """
+    Get interfaces and their IP addresses for each element-attach, using
+    a pool of worker threads sharing one BECS session
+    elements is a dict, key is oid value is element
+    Yields (oid, element, interfaces) in the order the requests completes
+    """
+    # Let each worker keep its own connection to BECS
+    common.mount_http_pool(becs.client.transport.session, workers)
+
+    # If a request fails, the requests not yet started are cancelled
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {}
+        for oid, element in elements.items():
+            futures[executor.submit(becs.get_interface, oid)] = (oid, element)
+        for future in concurrent.futures.as_completed(futures):
+            oid, element = futures[future]
+            yield oid, element, future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def get_interfaces_bulk(becs, elements):
+    """
+    Get interfaces and their IP addresses for all element-attach, with one
+    objectTreeFind from the BECS root. Interfaces are joined to their
+    element-attach, and resource-inets to their interface, using dicts
+    keyed on parentoid
+    elements is a dict, key is oid value is element
+    Yields (oid, element, interfaces)
+    """
+    print("----- Get interface tree from BECS -----")
+    data = becs.client.service.objectTreeFind(
+        {
+            "oid": config.becs.get("root_oid", 1),
+            "classmask": "element-attach,interface,resource-inet",
+            "walkdown": 0,      # No limit
+        },
+        _soapheaders=becs._soapheaders
+    )
+
+    # Get IP address for each interface, first resource-inet wins
+    prefixes = {}   # key is interface oid, value is prefix
+    for obj in data["objects"]:
+        if obj["class"] == "resource-inet" and obj["parentoid"] not in prefixes:
+            prefixes[obj["parentoid"]] = "%s/%d" % (obj["resource"]["address"], obj["resource"]["prefixlen"])
+
+    interfaces = {oid: [] for oid in elements}  # key is element-attach oid
+    for obj in data["objects"]:
+        if obj["class"] != "interface" or obj["parentoid"] not in interfaces:
+            continue
+        flags = obj["flags"]
+        if flags is None:
+            active = True
+        else:
+            active = flags.find("disable") < 0
+        interfaces[obj["parentoid"]].append(AttrDict(
+            name=obj["name"],
+            role=obj["role"],
+            prefix=prefixes.get(obj["oid"]),
+            active=active,
+        ))
+
+    for oid, element in elements.items():
+        yield oid, element, interfaces[oid]
 
 
 def store_elements_in_db(becs):
     """
     Get all elements (element-attach) from BECS and store in
     local sqlite3 database
+    Returns True if the database was changed
     """
+    init_config()
     print("----- Get elements from BECS -----")
     becs.get_elements()
 
-    db, cursor = common.create_db(config.sync_db, src="becs")
+    sync_db = common.Sync_Db(config.sync_db, src="becs",
+                             chunk_size=config.get("sync_db_chunk_size", 1000))
 
     print("----- Save elements in local database -----")
     element_count = 0
     interface_count = 0
-    for oid, element in becs.elements_oid.items():
-        if element["elementtype"] != "ibos":
-            continue
+    ibos_elements = {oid: element for oid, element in becs.elements_oid.items() if element["elementtype"] == "ibos"}
+    if config.becs.get("bulk_interfaces", True):
+        all_interfaces = get_interfaces_bulk(becs, ibos_elements)
+    else:
+        all_interfaces = get_interfaces(becs, ibos_elements, workers=config.becs.get("workers", 8))
+    for oid, element, interfaces in all_interfaces:
         print(element["name"])
         #print(element)
 
@@ -58,9 +150,6 @@ def store_elements_in_db(becs):
         else:
             active = flags.find("disable") < 0
 
-        # Get interfaces and their IP addresses for this element-attach
-        interfaces = becs.get_interface(oid)
-
         # Get management IPv4 address, default is to use loopback interface
         for interface in interfaces:
             if interface.name == "loopback0" and interface.prefix:
@@ -71,8 +160,8 @@ def store_elements_in_db(becs):
             # No loopback found or no prefix on loopback, pick first interface with an interface address
             for interface in interfaces:
                 if interface.prefix:
-                    print("No loopback ip address found, using interface %s, %s" % (interface.name, interface.ipv4_addr))
-                    element.ipv4_addr = interface.ipv4_prefix
+                    print("No loopback ip address found, using interface %s, %s" % (interface.name, interface.prefix))
+                    element.ipv4_addr = interface.prefix
                     break
 
         if element.ipv4_addr:
@@ -85,53 +174,22 @@ def store_elements_in_db(becs):
 
         element_count += 1
 
-        sql = "INSERT INTO elements ("
-        sql += "  hostname"
-        sql += " ,manufacturer"
-        sql += " ,model"
-        sql += " ,comments"
-        sql += " ,tags"
-        sql += " ,parents"
-        sql += " ,role"
-        sql += " ,site_name"
-        sql += " ,platform"
-        sql += " ,ipv4_addr"
-        sql += " ,ipv6_addr"
-        sql += " ,active"
-        sql += " ,alarm_timeperiod"
-        sql += " ,alarm_destination"
-        sql += " ,connection_method"
-        sql += " ,monitor_icinga"
-        sql += " ,monitor_librenms"
-        sql += " ,backup_oxidized"
-        sql += " ,_src"
-        sql += ") values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
-
         # todo        element["elementrole"],       # 
         # todo        element["role"],              # 'access.layer3'
-        cursor.execute(sql, (
-            element["name"],
-            "Waystream",           # element.manufacturer
-            "",                    # element.model
-            "",                    # element.comments
-            "",                    # element.tags
-            element["_parents"],   # element.parents
-            "Access nod",          # element.role     parameters[x]["name"] == "model", parameters[x]["values"][0] = 'ASR5124'
-            "",                    # element.site_name
-            element.elementtype,   # ibos
-            element.ipv4_addr,
-            element.ipv6_addr,
-            common.bool_to_int(active),
-            element["_alarm_timeperiod"],
-            element["_alarm_destination"],
-            "telnet",              # element.connection_method,
-            1,                     # element.monitor_icinga
-            1,                     # element.monitor_librenms
-            0,                     # element.backup_oxidized
-            "becs",                # _src
-            )
+        db_element = common.Element(
+            hostname=element["name"],
+            manufacturer="Waystream",
+            parents=common.commastr_to_list(element["_parents"]),
+            role="Access nod",     # parameters[x]["name"] == "model", parameters[x]["values"][0] = 'ASR5124'
+            platform=element.elementtype,   # ibos
+            ipv4_addr=element.ipv4_addr,
+            ipv6_addr=element.ipv6_addr,
+            active=active,
+            alarm_timeperiod=element["_alarm_timeperiod"],
+            alarm_destination=common.commastr_to_list(element["_alarm_destination"]),
+            connection_method="telnet",
+            backup_oxidized=False,
         )
-        element_id = cursor.lastrowid
 
         for interface in interfaces:
             if interface.prefix:
@@ -140,29 +198,27 @@ def store_elements_in_db(becs):
             if not prefix:
                 prefix = ""
             interface_count += 1
-            cursor.execute(
-                "INSERT INTO interfaces (elementid,name,role,ipv4_prefix,ipv6_prefix,active,_src) values (?,?,?,?,?,?,?)", (
-                element_id,
-                interface.name,
-                interface.role,
-                prefix,
-                "",    # todo ipv6_prefix
-                interface.active,
-                "becs",
-                )
+            db_element.interfaces[interface.name] = common.Interface(
+                name=interface.name,
+                role=interface.role,
+                ipv4_prefix=prefix,
+                ipv6_prefix="",    # todo
+                active=interface.active,
             )
+        sync_db.store(db_element)
     
-    cursor.execute("COMMIT")
-    cursor.close()
-    db.close()
+    sync_db.commit()
     print("Summary")
     print("   Total elements :", len(becs.elements_oid))
     print("   Saved elements :", element_count)
     print("   Interfaces     :", interface_count)
+    sync_db.print_summary()
+    return sync_db.changed()
 
 
 def main():
-    becs = BECS(config.becs.eapi, config.becs.username, config.becs.password)
+    init_config()
+    becs = get_becs()
     store_elements_in_db(becs)
     becs.logout()
 
@@ -3,61 +3,273 @@
 Common functions for sync utils
 """
 
+import os
+import time
+import hashlib
 import sqlite3
 
 from orderedattrdict import AttrDict
 
 
-class Element(AttrDict):
+# Columns in the elements and interfaces tables, in the order the sync
+# scripts provides the values. Does not include id, elementid, _src and _hash
+ELEMENT_COLUMNS = (
+    "hostname",
+    "manufacturer",
+    "model",
+    "comments",
+    "tags",
+    "parents",
+    "role",
+    "site_name",
+    "platform",
+    "ipv4_addr",
+    "ipv6_addr",
+    "active",
+    "alarm_timeperiod",
+    "alarm_destination",
+    "connection_method",
+    "monitor_icinga",
+    "monitor_librenms",
+    "backup_oxidized",
+)
+
+INTERFACE_COLUMNS = (
+    "name",
+    "role",
+    "ipv4_prefix",
+    "ipv6_prefix",
+    "active",
+)
+
+
+class Element:
     """
     Representation of an element, in NetBox or BECS
+
+    Attributes are slots, list defaults are created per instance
+    interfaces is a dict, key is interface name, value is Interface
     """
-    _defaults = {
-        "active": True,
-        "alarm_destination": [],
-        "alarm_timeperiod": "",
-        "backup_oxidized": True,
-        "comments": "",
-        "connection_method": "ssh",
-        "role": "",
-        "hostname": "",
-        "ipv4_addr": "",
-        "ipv6_addr": "",
-        "interfaces": AttrDict(),
-        "manufacturer": "",
-        "model": "",
-        "monitor_icinga": True,
-        "monitor_librenms": True,
-        "parents": [],
-        "platform": "",
-        "site_name": "",
-        "tags": [],
-    }
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        for attr, default in self._defaults.items():
-            if not hasattr(self, attr):
-                setattr(self, attr, default)
-
-
-class Interface(AttrDict):
+    __slots__ = ELEMENT_COLUMNS + ("interfaces",)
+
+    def __init__(self,
+                 hostname="",
+                 manufacturer="",
+                 model="",
+                 comments="",
+                 tags=None,
+                 parents=None,
+                 role="",
+                 site_name="",
+                 platform="",
+                 ipv4_addr="",
+                 ipv6_addr="",
+                 active=True,
+                 alarm_timeperiod="",
+                 alarm_destination=None,
+                 connection_method="ssh",
+                 monitor_icinga=True,
+                 monitor_librenms=True,
+                 backup_oxidized=True,
+                 interfaces=None):
+        self.hostname = hostname
+        self.manufacturer = manufacturer
+        self.model = model
+        self.comments = comments
+        self.tags = [] if tags is None else tags
+        self.parents = [] if parents is None else parents
+        self.role = role
+        self.site_name = site_name
+        self.platform = platform
+        self.ipv4_addr = ipv4_addr
+        self.ipv6_addr = ipv6_addr
+        self.active = active
+        self.alarm_timeperiod = alarm_timeperiod
+        self.alarm_destination = [] if alarm_destination is None else alarm_destination
+        self.connection_method = connection_method
+        self.monitor_icinga = monitor_icinga
+        self.monitor_librenms = monitor_librenms
+        self.backup_oxidized = backup_oxidized
+        self.interfaces = {} if interfaces is None else interfaces
+
+    def __repr__(self):
+        return "Element(hostname=%r, interfaces=%d)" % (self.hostname, len(self.interfaces))
+
+    def to_row(self):
+        """
+        Return a tuple of values, in ELEMENT_COLUMNS order
+        """
+        return (
+            self.hostname,
+            self.manufacturer,
+            self.model,
+            self.comments,
+            ",".join(self.tags),
+            ",".join(self.parents),
+            self.role,
+            self.site_name,
+            self.platform,
+            self.ipv4_addr,
+            self.ipv6_addr,
+            bool_to_int(self.active),
+            self.alarm_timeperiod,
+            ",".join(self.alarm_destination),
+            self.connection_method,
+            bool_to_int(self.monitor_icinga),
+            bool_to_int(self.monitor_librenms),
+            bool_to_int(self.backup_oxidized),
+        )
+
+    @classmethod
+    def from_row(cls, row, domain=None):
+        """
+        Create an Element from a row in the elements table, interfaces are
+        not included. domain is added to parents without domain
+        """
+        return cls(
+            hostname=row["hostname"],
+            manufacturer=row["manufacturer"],
+            model=row["model"],
+            comments=row["comments"],
+            tags=commastr_to_list(row["tags"]),
+            parents=commastr_to_list(row["parents"], domain=domain),
+            role=row["role"],
+            site_name=row["site_name"],
+            platform=row["platform"],
+            ipv4_addr=row["ipv4_addr"],
+            ipv6_addr=row["ipv6_addr"],
+            active=row["active"] == 1,
+            alarm_timeperiod=row["alarm_timeperiod"],
+            alarm_destination=commastr_to_list(row["alarm_destination"]),
+            connection_method=row["connection_method"],
+            monitor_icinga=row["monitor_icinga"] == 1,
+            monitor_librenms=row["monitor_librenms"] == 1,
+            backup_oxidized=row["backup_oxidized"] == 1,
+        )
+
+    def to_json(self):
+        """
+        Return a dict that can be serialized to JSON
+        """
+        return {
+            "active": self.active,
+            "alarm_destination": self.alarm_destination,
+            "alarm_timeperiod": self.alarm_timeperiod,
+            "backup_oxidized": self.backup_oxidized,
+            "comments": self.comments,
+            "connection_method": self.connection_method,
+            "role": self.role,
+            "hostname": self.hostname,
+            "ipv4_addr": self.ipv4_addr,
+            "ipv6_addr": self.ipv6_addr,
+            "interfaces": {name: interface.to_json() for name, interface in self.interfaces.items()},
+            "manufacturer": self.manufacturer,
+            "model": self.model,
+            "monitor_icinga": self.monitor_icinga,
+            "monitor_librenms": self.monitor_librenms,
+            "parents": self.parents,
+            "platform": self.platform,
+            "site_name": self.site_name,
+            "tags": self.tags,
+        }
+
+
+class Interface:
     """
     Representation of an interface, in NetBox or BECS
     """
-    _defaults = {
-        "active": True,
-        "name": "",
-        "ipv4_prefix": "",
-        "ipv6_prefix": "",
-        "role": "",
-    }
+    __slots__ = INTERFACE_COLUMNS
+
+    def __init__(self, name="", role="", ipv4_prefix="", ipv6_prefix="", active=True):
+        self.name = name
+        self.role = role
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.active = active
+
+    def __repr__(self):
+        return "Interface(name=%r)" % self.name
+
+    def to_row(self):
+        """
+        Return a tuple of values, in INTERFACE_COLUMNS order
+        """
+        return (
+            self.name,
+            self.role,
+            self.ipv4_prefix,
+            self.ipv6_prefix,
+            bool_to_int(self.active),
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Create an Interface from a row in the interfaces table
+        """
+        return cls(
+            name=row["name"],
+            role=row["role"],
+            ipv4_prefix=row["ipv4_prefix"],
+            ipv6_prefix=row["ipv6_prefix"],
+            active=row["active"] == 1,
+        )
+
+    def to_json(self):
+        """
+        Return a dict that can be serialized to JSON
+        """
+        return {
+            "active": self.active,
+            "name": self.name,
+            "ipv4_prefix": self.ipv4_prefix,
+            "ipv6_prefix": self.ipv6_prefix,
+            "role": self.role,
+        }
+
+
+# Loaded configurations, key is filename, value is (mtime and size, config)
+configs = {}
+
+
+def load_config(filename, loader):
+    """
+    Return the configuration in a YAML file, parsed with loader (utils.load_config)
+
+    The parsed configuration is kept for the life of the process, and only
+    parsed again when the mtime or size of the file has changed, so a
+    long running process (sync_all.py --daemon) picks up edits
+    """
+    try:
+        st = os.stat(filename)
+        key = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None      # Let the loader handle it
+    cached = configs.get(filename)
+    if cached is not None and key is not None and cached[0] == key:
+        return cached[1]
+    config = loader(filename)
+    configs[filename] = (key, config)
+    return config
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        for attr, default in self._defaults.items():
-            if not hasattr(self, attr):
-                setattr(self, attr, default)
+
+def mount_http_pool(session, maxsize):
+    """
+    Mount a new HTTPAdapter for http:// and https:// on a requests session,
+    keeping up to maxsize connections per host, so each worker thread
+    can keep its own connection
+    This overrides the adapters already mounted on the session, only the
+    retry policy (max_retries) of the replaced adapter is kept
+    Returns the session
+    """
+    import requests
+
+    for prefix in ("http://", "https://"):
+        old = session.get_adapter(prefix)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxsize,
+                                                max_retries=getattr(old, "max_retries", 0))
+        session.mount(prefix, adapter)
+    return session
 
 
 def bool_to_int(b):
@@ -66,11 +278,26 @@ def bool_to_int(b):
     return 0
 
 
-def create_db(filename, src=None):
+def create_db(filename, cache_size=-65536, journal_size_limit=67108864):
+    """
+    Open the sync database, create tables and indexes if needed
+    cache_size is in pages, or in KiB if negative (sqlite semantics)
+    journal_size_limit is the size in bytes the -wal file is truncated to
+    after a checkpoint
+    """
     db = sqlite3.connect(filename)
     cursor = db.cursor()
     cursor.row_factory = sqlite3.Row
 
+    # WAL lets the API read while a sync is writing, and with WAL
+    # synchronous=NORMAL is still safe against corruption
+    # A WAL reader must be able to create the -wal and -shm files, the
+    # directory of the database must be writable by the API user, see README
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA journal_size_limit=%d" % journal_size_limit)
+    cursor.execute("PRAGMA cache_size=%d" % cache_size)
+
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS elements ("\
         "  id INTEGER PRIMARY KEY AUTOINCREMENT" \
@@ -93,6 +320,7 @@ def create_db(filename, src=None):
         "  ,monitor_librenms INTEGER" \
         "  ,backup_oxidized INTEGER" \
         "  ,_src TEXT" \
+        "  ,_hash TEXT" \
         ")"
     )
     cursor.execute(
@@ -105,29 +333,393 @@ def create_db(filename, src=None):
         "  ,ipv6_prefix TEXT" \
         "  ,active INTEGER" \
         "  ,_src TEXT" \
+        "  ,_hash TEXT" \
         ")"
     )
 
-    # Remove all old elements/interfaces, in a transaction
-    cursor.execute("BEGIN")   
-    cursor.execute("DELETE FROM elements WHERE _src=?", (src,))
-    cursor.execute("DELETE FROM interfaces WHERE _src=?", (src,))
-    #cursor.execute("DELETE FROM sqlite_sequence WHERE name='elements'")
-    #cursor.execute("DELETE FROM sqlite_sequence WHERE name='interfaces'")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS sync_meta ("\
+        "  _src TEXT PRIMARY KEY" \
+        "  ,generation INTEGER" \
+        "  ,last_sync REAL" \
+        ")"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS sync_state ("\
+        "  _src TEXT PRIMARY KEY" \
+        "  ,high_water TEXT" \
+        ")"
+    )
+    # Databases created before incremental sync has no _hash column
+    for table in ("elements", "interfaces"):
+        columns = [row["name"] for row in cursor.execute("PRAGMA table_info(%s)" % table)]
+        if "_hash" not in columns:
+            cursor.execute("ALTER TABLE %s ADD COLUMN _hash TEXT" % table)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS elements_hostname ON elements(hostname)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS elements_src ON elements(_src)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS interfaces_elementid ON interfaces(elementid)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS interfaces_src ON interfaces(_src)")
 
     return db, cursor
 
-def commastr_to_list(hostnames, add_domain=False):
+
+def bump_generation(cursor, src):
+    """
+    Increment the sync generation for src, and record the time of the sync
+    Must be called inside the sync transaction, just before COMMIT, so readers
+    of the database can tell that the content has changed
+    """
+    cursor.execute(
+        "INSERT INTO sync_meta (_src,generation,last_sync) values (?,1,?)" \
+        "  ON CONFLICT(_src) DO UPDATE SET" \
+        "  generation=generation+1" \
+        "  ,last_sync=excluded.last_sync",
+        (src, time.time())
+    )
+
+
+def get_high_water(filename, src):
+    """
+    Return the high-water mark saved by the last sync of src, or None
+    """
+    db = sqlite3.connect(filename)
+    try:
+        row = db.execute("SELECT high_water FROM sync_state WHERE _src=?", (src,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None   # No sync_state table yet
+    db.close()
+    if row:
+        return row[0]
+    return None
+
+
+def read_elements(db, where=(), params=(), limit=None, interfaces=True, domain=None, with_id=False):
+    """
+    Generator, yields the Elements matching the SQL conditions in where,
+    ordered on hostname, with their interfaces unless interfaces is False
+    With with_id, yields (element id, Element), the id orders elements
+    with the same hostname from different sources
+
+    Elements and interfaces are read with two cursors, both ordered on
+    (hostname, element id), and merged. Call inside a read transaction,
+    so both queries see the same version of the database
+    db must use sqlite3.Row as row_factory, domain is added to parents
+    without domain
+    """
+    sql_where = ""
+    if where:
+        sql_where = " WHERE " + " AND ".join(where)
+    params = list(params) + [limit or -1]    # LIMIT -1 is no limit
+    elements = db.execute("SELECT * FROM elements%s ORDER BY hostname,id LIMIT ?" % sql_where, params)
+    interface_row = None
+    if interfaces:
+        interface_cursor = db.execute(
+            "SELECT interfaces.* FROM" \
+            "  (SELECT id,hostname FROM elements%s ORDER BY hostname,id LIMIT ?) AS e" \
+            "  JOIN interfaces ON interfaces.elementid=e.id" \
+            "  ORDER BY e.hostname,e.id,interfaces.id" % sql_where, params)
+        interface_row = interface_cursor.fetchone()
+
+    for element_row in elements:
+        element = Element.from_row(element_row, domain=domain)
+        while interface_row is not None and interface_row["elementid"] == element_row["id"]:
+            interface = Interface.from_row(interface_row)
+            element.interfaces[interface.name] = interface
+            interface_row = interface_cursor.fetchone()
+        if with_id:
+            yield element_row["id"], element
+        else:
+            yield element
+
+
+def get_elements(filename, domain=None):
+    """
+    Return all elements in the sync database, the same way the elements API
+    returns them. A dict, key is hostname, value is the element as a dict
+    """
+    db = sqlite3.connect(filename, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    try:
+        db.execute("BEGIN")
+        return {element.hostname: element.to_json() for element in read_elements(db, domain=domain)}
+    finally:
+        db.close()
+
+
+def row_hash(values):
+    """
+    Return a content hash for a tuple of column values
+    """
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+class Sync_Db:
+    """
+    Incremental sync of elements and interfaces from one source (_src)
+    to the local database.
+
+    Elements are keyed on (hostname, _src), interfaces on (elementid, name).
+    Rows are only written if their content hash changed, rows that was not
+    stored during this sync are deleted in commit(). Row ids are therefore
+    stable between syncs, and a sync of an unchanged source writes nothing.
+
+    The existing rows are read when the Sync_Db is created, without keeping
+    a lock. Changed rows are staged in memory while the source is fetched,
+    and published in commit() in one short write transaction, with
+    executemany() chunk_size rows at a time. A slow source therefore never
+    holds the write lock, and readers see either the previous or the
+    complete new sync
+
+    Ids of new rows are allocated when staged, and moved in commit() if
+    another source has inserted rows since. If another sync of the same
+    source has committed changes since, commit() fails
+
+    If full is False only a subset of the source is stored, for example
+    objects changed since the last sync. Elements not stored are then kept,
+    and must be removed with delete()
+    """
+
+    def __init__(self, filename, src, chunk_size=1000, full=True):
+        self.src = src
+        self.chunk_size = chunk_size
+        self.full = full
+        self.db, self.cursor = create_db(filename)
+        # One read transaction, so ids, hashes and generation are consistent
+        self.cursor.execute("BEGIN")
+        self.count = AttrDict(
+            elements=AttrDict(inserted=0, updated=0, deleted=0, unchanged=0),
+            interfaces=AttrDict(inserted=0, updated=0, deleted=0, unchanged=0),
+        )
+
+        # Load id and hash of existing rows
+        self.elements = {}      # key is hostname, value is (id, hash)
+        self.cursor.execute("SELECT id,hostname,_hash FROM elements WHERE _src=?", (src,))
+        for row in self.cursor.fetchall():
+            self.elements[row["hostname"]] = (row["id"], row["_hash"])
+        self.interfaces = {}    # key is (elementid, name), value is (id, hash)
+        self.cursor.execute("SELECT id,elementid,name,_hash FROM interfaces WHERE _src=?", (src,))
+        for row in self.cursor.fetchall():
+            self.interfaces[(row["elementid"], row["name"])] = (row["id"], row["_hash"])
+
+        # New rows gets their id here, so interfaces can refer to an element
+        # before it is written. Moved in commit() if the ids has been taken
+        self.first_element_id = self.next_element_id = self.next_id("elements")
+        self.first_interface_id = self.next_interface_id = self.next_id("interfaces")
+        self.generation = self.get_generation()
+        self.cursor.execute("COMMIT")
+
+        self.seen_elements = set()      # id of stored elements
+        self.seen_interfaces = set()    # id of stored interfaces
+        self.deleted_elements = set()   # id of elements removed with delete()
+        self.keep_interfaces = set()    # id of elements whose interfaces are not synced
+        self.high_water = None
+
+        # Rows waiting to be written
+        self.insert_elements = []
+        self.update_elements = []
+        self.insert_interfaces = []
+        self.update_interfaces = []
+
+        columns = ("id",) + ELEMENT_COLUMNS + ("_src", "_hash")
+        self.sql_insert_element = "INSERT INTO elements (%s) values (%s)" % \
+            (",".join(columns), ",".join("?" * len(columns)))
+        self.sql_update_element = "UPDATE elements SET %s WHERE id=?" % \
+            ",".join("%s=?" % column for column in columns[1:])
+        columns = ("id", "elementid") + INTERFACE_COLUMNS + ("_src", "_hash")
+        self.sql_insert_interface = "INSERT INTO interfaces (%s) values (%s)" % \
+            (",".join(columns), ",".join("?" * len(columns)))
+        self.sql_update_interface = "UPDATE interfaces SET %s WHERE id=?" % \
+            ",".join("%s=?" % column for column in columns[1:])
+
+    def next_id(self, table):
+        """
+        Return next free id in table, never reusing ids (AUTOINCREMENT semantics)
+        """
+        self.cursor.execute("SELECT MAX(id) FROM %s" % table)
+        max_id = self.cursor.fetchone()[0] or 0
+        self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,))
+        row = self.cursor.fetchone()
+        if row and row[0] > max_id:
+            max_id = row[0]
+        return max_id + 1
+
+    def get_generation(self):
+        self.cursor.execute("SELECT generation FROM sync_meta WHERE _src=?", (self.src,))
+        row = self.cursor.fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def store(self, element, interfaces=True):
+        """
+        Store one Element, and its Interfaces in element.interfaces
+        If interfaces is False, the stored interfaces of the element are
+        kept as they are
+        Returns the element id, which for a new element can change in commit()
+        """
+        values = element.to_row()
+        h = row_hash(values)
+        element_id, old_hash = self.elements.get(element.hostname, (None, None))
+        if element_id is None:
+            element_id = self.next_element_id
+            self.next_element_id += 1
+            self.insert_elements.append((element_id,) + values + (self.src, h))
+            self.elements[element.hostname] = (element_id, h)
+            self.count.elements.inserted += 1
+        elif h != old_hash:
+            self.update_elements.append(values + (self.src, h, element_id))
+            self.count.elements.updated += 1
+        else:
+            self.count.elements.unchanged += 1
+        self.seen_elements.add(element_id)
+
+        if not interfaces:
+            self.keep_interfaces.add(element_id)
+            return element_id
+
+        for interface in element.interfaces.values():
+            values = interface.to_row()
+            key = (element_id, interface.name)
+            h = row_hash(values)
+            interface_id, old_hash = self.interfaces.get(key, (None, None))
+            if interface_id is None:
+                interface_id = self.next_interface_id
+                self.next_interface_id += 1
+                self.insert_interfaces.append((interface_id, element_id) + values + (self.src, h))
+                self.interfaces[key] = (interface_id, h)
+                self.count.interfaces.inserted += 1
+            elif h != old_hash:
+                self.update_interfaces.append((element_id,) + values + (self.src, h, interface_id))
+                self.count.interfaces.updated += 1
+            else:
+                self.count.interfaces.unchanged += 1
+            self.seen_interfaces.add(interface_id)
+        return element_id
+
+    def delete(self, hostname):
+        """
+        Delete an element and its interfaces, when commit() is called
+        """
+        if hostname in self.elements:
+            self.deleted_elements.add(self.elements[hostname][0])
+
+    def set_high_water(self, high_water):
+        """
+        Save a high-water mark for src, written in commit()
+        """
+        self.high_water = high_water
+
+    def move_new_ids(self):
+        """
+        Move the ids of staged new rows above the ids used in the database
+        now, in case another source has inserted rows since they were allocated
+        Must be called with the write lock held
+        """
+        element_shift = max(self.next_id("elements") - self.first_element_id, 0)
+        interface_shift = max(self.next_id("interfaces") - self.first_interface_id, 0)
+        if element_shift:
+            self.insert_elements = [(row[0] + element_shift,) + row[1:] for row in self.insert_elements]
+        if element_shift or interface_shift:
+            first_element_id = self.first_element_id
+            self.insert_interfaces = [
+                (row[0] + interface_shift, row[1] + element_shift if row[1] >= first_element_id else row[1]) + row[2:]
+                for row in self.insert_interfaces]
+
+    def flush(self):
+        """
+        Write all staged rows, chunk_size rows at a time
+        """
+        for sql, rows in (
+                (self.sql_insert_element, self.insert_elements),
+                (self.sql_update_element, self.update_elements),
+                (self.sql_insert_interface, self.insert_interfaces),
+                (self.sql_update_interface, self.update_interfaces)):
+            for i in range(0, len(rows), self.chunk_size):
+                self.cursor.executemany(sql, rows[i:i + self.chunk_size])
+        self.insert_elements = []
+        self.update_elements = []
+        self.insert_interfaces = []
+        self.update_interfaces = []
+
+    def changed(self):
+        """
+        Returns True if any row has been inserted, updated or deleted
+        """
+        for count in self.count.values():
+            if count.inserted or count.updated or count.deleted:
+                return True
+        return False
+
+    def commit(self):
+        """
+        Publish the sync in one write transaction. Write staged rows, delete
+        all elements and interfaces not stored during this sync (or removed
+        with delete() if not a full sync), commit and close the database
+        Returns the inserted/updated/deleted counts
+        Raises RuntimeError if another sync of the same source has committed
+        changes since this Sync_Db was created
+        """
+        self.cursor.execute("BEGIN IMMEDIATE")
+        if self.get_generation() != self.generation:
+            self.cursor.execute("ROLLBACK")
+            self.db.close()
+            raise RuntimeError("Sync database changed by another sync of %s, nothing written" % self.src)
+        self.move_new_ids()
+        self.flush()
+
+        if self.full:
+            deleted_elements = set(id_ for id_, h in self.elements.values() if id_ not in self.seen_elements)
+        else:
+            deleted_elements = self.deleted_elements - self.seen_elements
+        self.cursor.executemany("DELETE FROM elements WHERE id=?", [(id_,) for id_ in deleted_elements])
+        self.count.elements.deleted = len(deleted_elements)
+
+        # Remove interfaces no longer on a stored element, and on deleted elements
+        deleted = []
+        for (element_id, name), (id_, h) in self.interfaces.items():
+            if element_id in deleted_elements:
+                deleted.append((id_,))
+            elif element_id in self.keep_interfaces:
+                continue
+            elif id_ not in self.seen_interfaces and (self.full or element_id in self.seen_elements):
+                deleted.append((id_,))
+        self.cursor.executemany("DELETE FROM interfaces WHERE id=?", deleted)
+        self.count.interfaces.deleted = len(deleted)
+
+        if self.high_water is not None:
+            self.cursor.execute(
+                "INSERT INTO sync_state (_src,high_water) values (?,?)" \
+                "  ON CONFLICT(_src) DO UPDATE SET high_water=excluded.high_water",
+                (self.src, self.high_water)
+            )
+        if self.changed():
+            bump_generation(self.cursor, self.src)
+        self.cursor.execute("COMMIT")
+        self.cursor.close()
+        self.db.close()
+        return self.count
+
+    def print_summary(self):
+        """
+        Print number of inserted/updated/deleted/unchanged rows per table
+        """
+        for table, count in self.count.items():
+            print("   %-10s : inserted %d, updated %d, deleted %d, unchanged %d" % (
+                table, count.inserted, count.updated, count.deleted, count.unchanged))
+
+
+def commastr_to_list(hostnames, domain=None):
     """
     Return a list of names from a comma separated string
-    If add_domain is True, add default domain name if no . (dot) in hostname
+    If domain is set, add it to names without . (dot)
     """
     if hostnames:
         tmp = []
         for hostname in hostnames.split(","):
             hostname = hostname.strip()
-            if add_domain and "." not in hostname:
-                hostname += "." + config.default_domain
+            if domain and "." not in hostname:
+                hostname += "." + domain
             tmp.append(hostname)
         return tmp
     return []
@@ -16,86 +16,37 @@ CONFIG_OXIDIZED_FILE ="/etc/abtools/abtools_oxidized.yaml"
 
 import os
 import sys
-import requests
-import subprocess
+import stat
+import json
+import shlex
+import tempfile
 import ipaddress
+import hashlib
+import sqlite3
+import subprocess
+import concurrent.futures
 
 from orderedattrdict import AttrDict
 
+import config_parser
+from config_parser import Record, Record_Store, ifname_to_dnsname
+
 sys.path.insert(0, "/opt")
 import ablib.utils as utils
-from ablib.elements import Elements_Mgr
-from ablib.oxidized import Oxidized_Mgr
-
-print("----- Loading configuration -----")
-config = utils.load_config(CONFIG_FILE)
-config_oxidized = utils.load_config(CONFIG_OXIDIZED_FILE)
-
-def ifname_to_dnsname(hostname, ifname):
-    hostname = hostname.split(".")[0]
-    name = "%s.%s" % (hostname, ifname)
-    name = name.replace("/", "-").replace(" ", "")
-    return name
-
-class Config_Parser:
-    """
-    Parse a router/switch config
-    Try to handle different vendors syntax; cisco, huawei etc
-    Extract all interfaces and their IP addresses
-    returns an dict, key is interfacename value is {hostname, type, value}
-    """
-  
-    def parse(self, records, hostname, conf):
-        intf = None
-        ix = 0
-        while ix < len(conf):
-            line = conf[ix]
-            ix += 1
-            if not line.startswith("interface "):
-                continue
-            ifname = line[10:].lower()
-
-            # Shorten interface name if needed, and replace forward slash
-            name = ifname_to_dnsname(hostname, ifname)
-
-            # Loop through all config lines for this interface
-            while ix < len(conf):
-                line =  conf[ix].rstrip()
-                ix += 1
-                if line == "" or line[0] == "!" or line[0] == "#":
-                    break # end if this interface config
-                line = line.strip()
-                if line.startswith("ip address "):
-                    addr = line[11:].split()[0]
-                    try:
-                        tmp = ipaddress.IPv4Address(addr)
-                        record = AttrDict(hostname=name, type="A", value=addr, host=False)
-                        if name not in records:
-                            records[name] = record
-                    except ipaddress.AddressValueError:
-                        print("Error: hostname '%s', ipv4_addr '%s' incorrect" % (name, addr))
-
-                elif line.startswith("ipv4 address "):
-                    addr = line[12:].split()[0]
-                    try:
-                        tmp = ipaddress.IPv4Address(addr)
-                        record = AttrDict(hostname=name, type="A", value=addr, host=False)
-                        if name not in records:
-                            records[name] = record
-                    except ipaddress.AddressValueError:
-                        print("Error: hostname '%s', ipv4_addr '%s' incorrect" % (name, addr))
-
-                elif line.startswith("ipv6 address "):
-                    addr = line[13:].split("/")[0]
-                    try:
-                        tmp = ipaddress.IPv6Address(addr)
-                        record = AttrDict(hostname=name, type="AAAA", value=addr, host=False)
-                        if name not in records:
-                            records[name] = record
-                    except ipaddress.AddressValueError:
-                        print("Error: hostname '%s', ipv6_addr '%s' incorrect" % (name, addr))
-                
-        return records
+import sync_common as common
+
+config = None
+config_oxidized = None
+
+
+def init_config():
+    """
+    Load configuration, called by the entry points
+    """
+    global config, config_oxidized
+    print("----- Loading configuration -----")
+    config = common.load_config(CONFIG_FILE, utils.load_config)
+    config_oxidized = common.load_config(CONFIG_OXIDIZED_FILE, utils.load_config)
 
 
 def add_elements_api_hosts(elements=None, records=None):
@@ -110,11 +61,8 @@ def add_elements_api_hosts(elements=None, records=None):
         if element["ipv4_addr"]:
             if name.endswith(config.default_domain):
                 name = name[:-len(config.default_domain)-1]
-            if name in records:
-                continue
             addr = element["ipv4_addr"].split("/")[0]    # Remove prefixlen
-            record = AttrDict(hostname=name, type="A", value=addr, host=True)
-            records[name] = record
+            records.add(Record(name, "A", addr, host=True))
 
 
 def add_elements_api_interfaces(elements=None, records=None):
@@ -131,13 +79,136 @@ def add_elements_api_interfaces(elements=None, records=None):
                 if "ipv4_prefix" in interface and interface["ipv4_prefix"]:
                     name = ifname_to_dnsname(hostname, ifname)
                     addr = interface["ipv4_prefix"].split("/")[0]    # Remove prefixlen
-                    record = AttrDict(hostname=name, type="A", value=addr, host=False)
-                    if name not in records:
-                        records[name] = record
-                    else:
+                    if not records.add(Record(name, "A", addr)):
                         print("Error, name conflict, name %s already exist" % name)
 
 
+class Parse_Cache:
+    """
+    Persistent cache of records parsed from element configurations
+
+    An entry is used if the oxidized version of the configuration is the
+    same, or if the configuration content hash is the same, and the parser
+    version and the grammar selected for the element are the same
+    """
+
+    def __init__(self, filename, parser_version):
+        self.parser_version = parser_version
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS parse_cache ("\
+            "  hostname TEXT PRIMARY KEY" \
+            "  ,version TEXT" \
+            "  ,config_hash TEXT" \
+            "  ,parser_version TEXT" \
+            "  ,grammar TEXT" \
+            "  ,records TEXT" \
+            ")"
+        )
+        # Caches created before the grammar was part of the key
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(parse_cache)")]
+        if "grammar" not in columns:
+            self.db.execute("ALTER TABLE parse_cache ADD COLUMN grammar TEXT")
+        self.entries = {}   # key is hostname, value is (version, config_hash, parser_version, grammar, records)
+        for row in self.db.execute("SELECT hostname,version,config_hash,parser_version,grammar,records FROM parse_cache"):
+            self.entries[row[0]] = row[1:]
+        self.hits = 0
+
+    def get(self, hostname, grammar, version=None, config_hash=None):
+        """
+        Returns cached (name, type, value, vrf) tuples for hostname, or None
+        grammar is the name of the grammar selected for the element
+        """
+        entry = self.entries.get(hostname)
+        if entry is None or entry[2] != self.parser_version or entry[3] != grammar:
+            return None
+        if (version and entry[0] == version) or (config_hash and entry[1] == config_hash):
+            self.hits += 1
+            return [tuple(record) for record in json.loads(entry[4])]
+        return None
+
+    def put(self, hostname, grammar, version, config_hash, records):
+        data = json.dumps(records)
+        self.entries[hostname] = (version, config_hash, self.parser_version, grammar, data)
+        self.db.execute("INSERT OR REPLACE INTO parse_cache (hostname,version,config_hash,parser_version,grammar,records) values (?,?,?,?,?,?)",
+                        (hostname, version, config_hash, self.parser_version, grammar, data))
+
+    def delete(self, hostname):
+        if self.entries.pop(hostname, None) is not None:
+            self.db.execute("DELETE FROM parse_cache WHERE hostname=?", (hostname,))
+
+    def evict(self, hostnames):
+        """
+        Remove entries for all hostnames not in hostnames
+        """
+        hostnames = set(hostnames)
+        for hostname in list(self.entries):
+            if hostname not in hostnames:
+                self.delete(hostname)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def get_oxidized_versions(oxidized_mgr):
+    """
+    Get modification time of each stored configuration from the oxidized
+    REST API, with one request to nodes.json
+    The URL is the one Oxidized_Mgr uses (oxidized.url in the oxidized
+    configuration), and its session is used if it has one
+    Returns a dict, key is node name value is the version. Empty if the
+    listing is not available
+    """
+    import requests
+
+    versions = {}
+    url = config_oxidized.oxidized.get("url")
+    if not url:
+        return versions
+    session = getattr(oxidized_mgr, "session", None)
+    if not isinstance(session, requests.Session):
+        session = requests
+    try:
+        r = session.get(url.rstrip("/") + "/nodes.json", timeout=60)
+        r.raise_for_status()
+        nodes = r.json()
+    except (requests.RequestException, ValueError) as err:
+        print("Warning: Cannot get oxidized nodes.json, %s" % err)
+        return versions
+    for node in nodes:
+        mtime = node.get("mtime")
+        if mtime and mtime != "unknown":
+            versions[node["name"]] = str(mtime)
+    return versions
+
+
+def get_element_configs(oxidized_mgr, hostnames, workers=8):
+    """
+    Fetch last running-configuration for each hostname from oxidized, using
+    a pool of worker threads
+    Yields (hostname, config) in the order the downloads completes, config
+    is None if there is no backup
+    """
+    import requests
+
+    # Keep-alive connections for all workers, if Oxidized_Mgr uses a requests session
+    session = getattr(oxidized_mgr, "session", None)
+    if isinstance(session, requests.Session):
+        common.mount_http_pool(session, workers)
+
+    # If a download fails, the downloads not yet started are cancelled
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {}
+        for hostname in hostnames:
+            futures[executor.submit(oxidized_mgr.get_element_config, hostname)] = hostname
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
 def parse_element_config(oxidized_mgr=None, elements=None, records=None):
     """
     Go through all elements from element API
@@ -145,10 +216,19 @@ def parse_element_config(oxidized_mgr=None, elements=None, records=None):
     - parse each config file for interface addresses
     - Convert interface name to something that can be put in DNS
     - Adds record to records{}
+
+    Configurations are downloaded concurrently, and parsed as they arrive
+    in a pool of sync_dns.parse_workers processes (default one per core).
+    Records are merged in element order, the first record for a name wins
+
+    If sync_dns.parse_cache is set, parse results are cached. Elements whose
+    oxidized version is unchanged are not downloaded, elements whose
+    configuration hash is unchanged are not parsed
     """
     print()
     print("----- Parsing all element configuration, searching for IP addresses")
-    parser = Config_Parser()
+    secondary = config.sync_dns.get("secondary_addresses", False)
+    hostnames = []
     for hostname, element in elements.items():
         if "backup_oxidized" in element and element["backup_oxidized"] == False:
             # print("  Ignoring backup_oxidized' is False, hostname '%s'" % hostname)
@@ -159,87 +239,337 @@ def parse_element_config(oxidized_mgr=None, elements=None, records=None):
         if "model" in element and element["model"] in config.sync_dns.ignore_models:
             # print("  Ignoring model '%s', hostname '%s'" % (element["model"], hostname))
             continue
+        hostnames.append(hostname)
+
+    cache = None
+    versions = {}
+    if config.sync_dns.get("parse_cache"):
+        cache = Parse_Cache(config.sync_dns.parse_cache, config_parser.parser_version(secondary))
+        versions = get_oxidized_versions(oxidized_mgr)
+
+    # Grammar used to parse each element, selected by platform and manufacturer
+    grammars = {}
+    for hostname in hostnames:
+        element = elements[hostname]
+        grammars[hostname] = config_parser.get_grammar(element.get("platform", ""),
+                                                       element.get("manufacturer", "")).name
+
+    # key is hostname, value is list of (name, type, value, vrf) from that element
+    element_records = {}
+    download = []
+    for hostname in hostnames:
+        if cache and versions.get(hostname):
+            tmp_records = cache.get(hostname, grammars[hostname], version=versions[hostname])
+            if tmp_records is not None:
+                element_records[hostname] = tmp_records
+                continue
+        download.append(hostname)
+
+    oxidized_workers = config.sync_dns.get("oxidized_workers", 8)
+    parse_workers = config.sync_dns.get("parse_workers") or os.cpu_count()
+    # Workers are started from a forkserver, not forked from this process,
+    # which has download threads running that can hold locks
+    import multiprocessing
+    mp_context = multiprocessing.get_context("forkserver")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers, mp_context=mp_context) as executor:
+        futures = {}    # key is hostname, value is (future, config_hash)
+        for hostname, element_conf in get_element_configs(oxidized_mgr, download, workers=oxidized_workers):
+            if element_conf is None:
+                print("Warning: Missing configuration backup for %s" % hostname)
+                if cache:
+                    cache.delete(hostname)
+                continue
+            config_hash = None
+            if cache:
+                config_hash = hashlib.sha1(element_conf.encode()).hexdigest()
+                tmp_records = cache.get(hostname, grammars[hostname], config_hash=config_hash)
+                if tmp_records is not None:
+                    cache.put(hostname, grammars[hostname], versions.get(hostname), config_hash, tmp_records)
+                    element_records[hostname] = tmp_records
+                    continue
+            element = elements[hostname]
+            futures[hostname] = (executor.submit(
+                config_parser.parse_records, hostname, element_conf,
+                element.get("platform", ""), element.get("manufacturer", ""), secondary),
+                config_hash)
+
+        for hostname, (future, config_hash) in futures.items():
+            element_records[hostname] = future.result()
+            if cache:
+                cache.put(hostname, grammars[hostname], versions.get(hostname), config_hash,
+                          element_records[hostname])
+
+    if cache:
+        cache.evict(hostnames)
+        cache.close()
+        print("Parse cache: %d hits, %d downloaded" % (cache.hits, len(download)))
+
+    for hostname in hostnames:
+        config_parser.add_records(records, element_records.get(hostname, ()))
+
+
+def render_dnsmgr_records(records):
+    """
+    Return the content of a DnsMgr records file
+    """
+    hosts, forward, reverse = records.partition()
+    out = []
+
+    out.append(";\n")
+    out.append("; Autogenerated from elements management address\n")
+    out.append(";\n")
+    out.append("$DOMAIN %s\n" % config.default_domain)
+
+    # Write forward entries, hostname
+    out.append(";\n")
+    out.append("; Forward entries, hostname\n")
+    out.append(";\n")
+    out.append("\n")
+    out.append("$FORWARD 1\n")
+    out.append("$REVERSE 1\n")
+    out.append("\n")
+    for record in hosts:
+        out.append("%-40s  %-4s   %s\n" % (record.hostname, record.type, record.value))
+
+    # Write forward entries, names that should not have reverse DNS
+    # typically loopbacks, which already have hostname entry
+    out.append(";\n")
+    out.append("; Forward entries, interfaces\n")
+    out.append(";\n")
+    out.append("\n")
+    out.append("$FORWARD 1\n")
+    out.append("$REVERSE 0\n")
+    out.append("\n")
+    for record in forward:
+        out.append("%-40s  %-4s   %s\n" % (record.hostname, record.type, record.value))
+
+    # Write reverse entries
+    out.append(";\n")
+    out.append("; Reverse entries, interfaces\n")
+    out.append(";\n")
+    out.append("\n")
+    out.append("$FORWARD 1\n")
+    out.append("$REVERSE 1\n")
+    out.append("\n")
+    out.append(";\n")
+    for record in reverse:
+        out.append("%-40s  %-4s   %s\n" % (record.hostname, record.type, record.value))
+
+    return "".join(out)
+
+
+def write_file_if_changed(filename, content):
+    """
+    Write content to filename, if the file content differs
+    The file is replaced atomically, readers see the old or the new file
+    Returns True if the file was written
+    """
+    data = content.encode()
+    try:
+        with open(filename, "rb") as f:
+            if hashlib.sha1(f.read()).digest() == hashlib.sha1(data).digest():
+                return False
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        mode = 0o644
+
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpname, mode)
+        os.replace(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+    return True
 
-        element_conf = oxidized_mgr.get_element_config(hostname)
-        if element_conf is not None:
-            tmp_records = parser.parse(records, hostname, element_conf.split("\n"))
-        else:
-            print("Warning: Missing configuration backup for %s" % hostname)
+
+def state_path(suffix):
+    """
+    Return the path of a state file for the records, in sync_dns.state_dir
+    Default state_dir is the directory of sync_db, so state is not written
+    next to the records file that dnsmgr reads
+    """
+    state_dir = config.sync_dns.get("state_dir") or os.path.dirname(os.path.abspath(config.sync_db))
+    return os.path.join(state_dir, os.path.basename(config.sync_dns.dest_record_file) + suffix)
 
 
 def write_dnsmgr_records(elements, records):
     """
     Write a DnsMgr records file, and ask DnsMgr to update nameserver
+    Nothing is done if the records file is unchanged, and the last
+    dnsmgr update was successful
     """
     print()
     print("----- Writing dnsmgr records -----")
-    ipv4_addr = {}
-
-    with open(config.sync_dns.dest_record_file, "w") as f:
-        f.write(";\n")
-        f.write("; Autogenerated from elements management address\n")
-        f.write(";\n")
-        f.write("$DOMAIN %s\n" % config.default_domain)
-
-        # Write forward entries, hostname
-        f.write(";\n")
-        f.write("; Forward entries, hostname\n")
-        f.write(";\n")
-        f.write("\n")
-        f.write("$FORWARD 1\n")
-        f.write("$REVERSE 1\n")
-        f.write("\n")
-        for record in records.values():
-            if record.host:
-                ipv4_addr[record.value] = 1
-                f.write("%-40s  %-4s   %s\n" % (record.hostname, record.type, record.value))
-
-        # Write forward entries, names that should not have reverse DNS
-        # typically loopbacks, which already have hostname entry
-        f.write(";\n")
-        f.write("; Forward entries, interfaces\n")
-        f.write(";\n")
-        f.write("\n")
-        f.write("$FORWARD 1\n")
-        f.write("$REVERSE 0\n")
-        f.write("\n")
-        for record in records.values():
-            if not record.host:
-                if record.value in ipv4_addr:
-                    f.write("%-40s  %-4s   %s\n" % (record.hostname, record.type, record.value))
-
-        # Write reverse entries
-        f.write(";\n")
-        f.write("; Reverse entries, interfaces\n")
-        f.write(";\n")
-        f.write("\n")
-        f.write("$FORWARD 1\n")
-        f.write("$REVERSE 1\n")
-        f.write("\n")
-        f.write(";\n")
-        for record in records.values():
-            if not record.host:
-                if record.value not in ipv4_addr:
-                    f.write("%-40s  %-4s   %s\n" % (record.hostname, record.type, record.value))
+    content = render_dnsmgr_records(records)
+    digest = hashlib.sha1(content.encode()).hexdigest()
+    changed = write_file_if_changed(config.sync_dns.dest_record_file, content)
+
+    # Hash of the records file, saved after a successful dnsmgr update
+    published_file = state_path(".published")
+    try:
+        with open(published_file) as f:
+            published = f.read().strip()
+    except FileNotFoundError:
+        published = None
+    if not changed and published == digest:
+        print("No changes in records, not updating DNS")
+        return
 
     print()
     print("----- Request dnsmgr to update DNS/bind -----")
-    os.system("/opt/dnsmgr/dnsmgr.py update")
+    subprocess.run(["/opt/dnsmgr/dnsmgr.py", "update"], check=True)
+    write_file_if_changed(published_file, digest + "\n")
 
 
-def main():
-    records = AttrDict()
+def get_record_set(records):
+    """
+    Return the records to publish, as a dict keyed on (name, type)
+    value is (value, reverse), reverse is True if a PTR record is published
+    """
+    record_set = {}
+    for record in records.values():
+        record_set[(record.hostname, record.type)] = (record.value, records.has_reverse(record))
+    return record_set
+
+
+def load_record_set(filename):
+    """
+    Load the previously published record set, returns None if there is none
+    """
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    return {(name, rtype): (value, reverse) for name, rtype, value, reverse in data}
+
+
+def save_record_set(filename, record_set):
+    data = [(name, rtype, value, reverse) for (name, rtype), (value, reverse) in record_set.items()]
+    write_file_if_changed(filename, json.dumps(data, indent=0))
+
+
+def diff_record_sets(old, new):
+    """
+    Compare two record sets
+    Returns AttrDict with lists added and removed of (key, value), and
+    changed of (key, old value, new value)
+    """
+    diff = AttrDict(added=[], removed=[], changed=[])
+    for key, value in new.items():
+        if key not in old:
+            diff.added.append((key, value))
+        elif old[key] != value:
+            diff.changed.append((key, old[key], value))
+    for key, value in old.items():
+        if key not in new:
+            diff.removed.append((key, value))
+    return diff
+
+
+def render_nsupdate(diff):
+    """
+    Return a nsupdate (RFC 2136 dynamic update) script, that applies diff
+    Forward records are sent in one update, each PTR record in its own
+    update since they can belong to different reverse zones
+    """
+    ttl = config.sync_dns.get("nsupdate_ttl", 3600)
+    delete = [(key, value) for key, value in diff.removed]
+    delete += [(key, old_value) for key, old_value, new_value in diff.changed]
+    add = [(key, value) for key, value in diff.added]
+    add += [(key, new_value) for key, old_value, new_value in diff.changed]
+
+    out = []
+    server = config.sync_dns.get("nsupdate_server")
+    if server:
+        out.append("server %s\n" % server)
+    for (name, rtype), (value, reverse) in delete:
+        out.append("update delete %s.%s. %s %s\n" % (name, config.default_domain, rtype, value))
+    for (name, rtype), (value, reverse) in add:
+        out.append("update add %s.%s. %d %s %s\n" % (name, config.default_domain, ttl, rtype, value))
+    out.append("send\n")
+
+    for (name, rtype), (value, reverse) in delete:
+        if reverse:
+            out.append("update delete %s. PTR\n" % ipaddress.ip_address(value).reverse_pointer)
+            out.append("send\n")
+    for (name, rtype), (value, reverse) in add:
+        if reverse:
+            out.append("update add %s. %d PTR %s.%s.\n" % (
+                ipaddress.ip_address(value).reverse_pointer, ttl, name, config.default_domain))
+            out.append("send\n")
+    return "".join(out)
+
+
+def publish_records(elements, records):
+    """
+    Publish records to DNS, and save the published record set
+
+    sync_dns.output selects how:
+      dnsmgr    write the complete dnsmgr records file, and run dnsmgr (default)
+      nsupdate  write a nsupdate script with only the changes since the last
+                published record set, and run sync_dns.nsupdate_command on it
+
+    The record set is only saved as published when the update succeeded.
+    Without nsupdate_command nothing is known to be published, the script
+    then has all changes since the last saved record set, so a script that
+    was not applied is never lost. Applying it again is harmless
+    """
+    record_set = get_record_set(records)
+    state_file = config.sync_dns.get("state_file") or state_path(".state.json")
+    old_record_set = load_record_set(state_file)
+    diff = diff_record_sets(old_record_set or {}, record_set)
+    print()
+    print("----- Records: %d added, %d removed, %d changed -----" % (len(diff.added), len(diff.removed), len(diff.changed)))
+
+    if config.sync_dns.get("output", "dnsmgr") == "nsupdate":
+        if old_record_set is not None and not (diff.added or diff.removed or diff.changed):
+            print("No changes in records, not updating DNS")
+            return
+        print("----- Writing nsupdate delta -----")
+        write_file_if_changed(config.sync_dns.nsupdate_file, render_nsupdate(diff))
+        command = config.sync_dns.get("nsupdate_command")
+        if not command:
+            print("No nsupdate_command, %s is left to be applied" % config.sync_dns.nsupdate_file)
+            return
+        subprocess.run(shlex.split(command) + [config.sync_dns.nsupdate_file], check=True)
+    else:
+        write_dnsmgr_records(elements, records)
+
+    save_record_set(state_file, record_set)
+
+
+def sync(elements=None):
+    """
+    Create DNS records for elements, and publish them
+    If elements is None, they are fetched through the elements API
+    """
+    from ablib.oxidized import Oxidized_Mgr
+
+    init_config()
+    records = Record_Store()
 
     oxidized_mgr = Oxidized_Mgr(config=config_oxidized.oxidized)
 
-    print("----- Get elements from Elements API -----")
-    elements_mgr = Elements_Mgr(config=config.elements)
-    elements = elements_mgr.get_elements()
+    if elements is None:
+        print("----- Get elements from Elements API -----")
+        from ablib.elements import Elements_Mgr
+        elements_mgr = Elements_Mgr(config=config.elements)
+        elements = elements_mgr.get_elements()
     
     add_elements_api_hosts(elements=elements, records=records)
     add_elements_api_interfaces(elements=elements, records=records)
     parse_element_config(oxidized_mgr=oxidized_mgr, elements=elements, records=records)
-    write_dnsmgr_records(elements, records)
+    publish_records(elements, records)
+
+
+def main():
+    sync()
 
 
 if __name__ == "__main__":
@@ -2,10 +2,14 @@
 """
 Fetch all elements from NetBox
 
-For each element, fetch all interfaces and their ipv4 addresses.
+If netbox.interfaces is set, fetch all interfaces and their ip addresses,
+using bulk listings.
 Write this to a sqlite3 database, protected by a transaction
 Columns in database uses the netbox names
 
+With --incremental, only devices and virtual machines changed since the
+last sync are fetched, deleted ones are found with a brief name listing
+
 dependencies:
     sudo pip3 install orderedattrdict
 """
@@ -13,10 +17,12 @@ dependencies:
 import sys
 import time
 import argparse
+import datetime
+import email.utils
 import sqlite3
+import concurrent.futures
 
 from orderedattrdict import AttrDict
-import pynetbox
 
 import sync_common as common
 
@@ -29,8 +35,26 @@ CONFIG_FILE="/etc/abtools/abtools_control.yaml"
 
 # ----- End of configuration items ------------------------------------------
 
-# Load configuration
-config = utils.load_config(CONFIG_FILE)
+config = None
+
+
+def init_config():
+    """
+    Load configuration, called by the entry points
+    """
+    global config
+    config = common.load_config(CONFIG_FILE, utils.load_config)
+
+
+def netbox_hostname(name):
+    """
+    Return the element hostname for a NetBox device or virtual machine name
+    """
+    hostname = name.lower()
+    if "." not in hostname:
+        hostname = "%s.%s" % (hostname, config.default_domain)
+    return hostname
+
 
 def parse_netbox_api_response(device):
     """
@@ -44,10 +68,7 @@ def parse_netbox_api_response(device):
         return None
 
     element = common.Element()
-    hostname = hostname.lower()
-    if "." not in hostname:
-        hostname = "%s.%s" % (hostname, config.default_domain)
-    element.hostname = hostname
+    element.hostname = netbox_hostname(hostname)
     
     try:
         element.manufacturer = device.device_type.manufacturer.name
@@ -64,7 +85,7 @@ def parse_netbox_api_response(device):
 
     try:
         parents = device.custom_fields["parents"]
-        element.parents = common.commastr_to_list(parents, add_domain=True)
+        element.parents = common.commastr_to_list(parents, domain=config.default_domain)
     except (AttributeError, NameError):
         pass
 
@@ -148,48 +169,178 @@ def parse_netbox_api_response(device):
     return element
 
 
-def get_from_netbox(elements, hostname=None, interfaces=False):
+# pynetbox api, created on first use
+netbox_api = None
+
+
+def get_netbox_api():
     """
-    Get one or all elements from NetBox, devices and virtual machines
-    No interfaces are included
+    Return a pynetbox api using a pooled http session. Pages of a listing
+    are fetched concurrently once the first page has returned the count
+    The api is created once, and its connections are reused by later syncs
     """
+    global netbox_api
+    if netbox_api is not None:
+        return netbox_api
+    import requests
+    import pynetbox
+
+    workers = config.netbox.get("workers", 4)
+    netbox = pynetbox.api(url=config.netbox.url, token=config.netbox.token,
+                          threading=True, max_workers=workers)
+    netbox.http_session = common.mount_http_pool(requests.Session(), workers * 2)
+    netbox_api = netbox
+    return netbox
 
-    netbox = pynetbox.api(url=config.netbox.url, token=config.netbox.token)
 
-    print("----- Get virtual machines from NetBox -----")
+def fetch_netbox(endpoint, hostname=None, since=None):
+    """
+    Get one named object, all objects, or objects changed since a
+    last_updated timestamp, from a NetBox endpoint
+    """
     if hostname:
-        # Get one element
-        if "." in hostname:
-            hostname = hostname.split(".", 1)[0]
-        data = [ netbox.virtualization.virtual_machines.get(name=hostname) ]
-    else:
-        # Get all elements
-        data = netbox.virtualization.virtual_machines.all()
+        return [ endpoint.get(name=hostname) ]
+    # limit is the page size, NetBox caps it at MAX_PAGE_SIZE
+    page_size = config.netbox.get("page_size", 1000)
+    if since:
+        return list(endpoint.filter(last_updated__gte=since, limit=page_size))
+    return list(endpoint.all(limit=page_size))
 
-    for device in data:
-        # utils.pretty_print("device", device)
-        element = parse_netbox_api_response(device)
-        if element:
-            # utils.pretty_print("element", element)
-            elements[element.hostname] = element
+
+def get_netbox_interfaces(netbox, elements):
+    """
+    Get interfaces with IP addresses for all elements, using bulk listings
+    of ip-addresses, device interfaces and virtual machine interfaces,
+    joined locally on assigned_object_id
+    Interfaces without IP address are not included
+    """
+    print("----- Get interfaces and IP addresses from NetBox -----")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        ip_addresses = executor.submit(fetch_netbox, netbox.ipam.ip_addresses)
+        dcim_interfaces = executor.submit(fetch_netbox, netbox.dcim.interfaces)
+        vm_interfaces = executor.submit(fetch_netbox, netbox.virtualization.interfaces)
+
+        # key is (assigned_object_type, interface id), value is (interface, device or vm)
+        nb_interfaces = {}
+        for nb_interface in dcim_interfaces.result():
+            nb_interfaces[("dcim.interface", nb_interface.id)] = (nb_interface, nb_interface.device)
+        for nb_interface in vm_interfaces.result():
+            nb_interfaces[("virtualization.vminterface", nb_interface.id)] = (nb_interface, nb_interface.virtual_machine)
+
+        for ip_address in ip_addresses.result():
+            key = (ip_address.assigned_object_type, ip_address.assigned_object_id)
+            if key not in nb_interfaces:
+                continue    # Not assigned to an interface
+            nb_interface, parent = nb_interfaces[key]
+            if parent is None or not parent.name:
+                continue
+            element = elements.get(netbox_hostname(parent.name))
+            if element is None:
+                continue
+
+            interface = element.interfaces.get(nb_interface.name)
+            if interface is None:
+                interface = common.Interface(name=nb_interface.name, active=nb_interface.enabled)
+                element.interfaces[interface.name] = interface
+            if ip_address.role and not interface.role:
+                interface.role = ip_address.role.value
+
+            # First address of each family wins
+            if ip_address.family.value == 6:
+                if not interface.ipv6_prefix:
+                    interface.ipv6_prefix = ip_address.address
+            elif not interface.ipv4_prefix:
+                interface.ipv4_prefix = ip_address.address
+
+
+def netbox_time(netbox):
+    """
+    Return the current time on the NetBox server, from the Date header of
+    a response, so the local clock does not matter. Falls back to the
+    local time if the server does not send a usable Date header
+    """
+    response = netbox.http_session.get(netbox.base_url + "/status/",
+                                       headers={"Authorization": "Token %s" % netbox.token})
+    try:
+        return email.utils.parsedate_to_datetime(response.headers["Date"])
+    except (KeyError, TypeError, ValueError):
+        return datetime.datetime.now(datetime.timezone.utc)
 
 
-    print("----- Get elements from NetBox -----")
+def get_from_netbox(elements, hostname=None, interfaces=False, since=None, device_hostnames=None):
+    """
+    Get one or all elements from NetBox, devices and virtual machines
+    If since is set, only get elements changed since that last_updated timestamp
+    A device replaces a virtual machine with the same name. In an incremental
+    sync the device may not be fetched, virtual machines with a hostname in
+    device_hostnames are then skipped
+    If interfaces is True, interfaces with IP addresses are included
+    Devices and virtual machines are fetched concurrently
+    Returns the high-water mark for the next incremental sync, or None
+
+    The high-water mark is the NetBox time when the fetch started, minus
+    netbox.incremental_overlap seconds. Pages and endpoints are fetched
+    concurrently, so an object saved during the fetch can be missed by a
+    page that was already read. It has a last_updated after the start, and
+    is fetched by the next incremental sync. The overlap covers objects
+    whose transaction commits after the fetch has started
+    """
+
+    netbox = get_netbox_api()
+
+    high_water = None
     if hostname:
         # Get one element
         if "." in hostname:
             hostname = hostname.split(".", 1)[0]
-        data = [ netbox.dcim.devices.get(name=hostname) ]
     else:
-        # Get all elements
-        data = netbox.dcim.devices.all()
-
-    for device in data:
-        #utils.pretty_print("device", device)
-        element = parse_netbox_api_response(device)
-        if element:
-            # utils.pretty_print("element", element)
-            elements[element.hostname] = element
+        overlap = config.netbox.get("incremental_overlap", 60)
+        high_water = (netbox_time(netbox) - datetime.timedelta(seconds=overlap)).isoformat()
+
+    print("----- Get virtual machines and elements from NetBox -----")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        vms = executor.submit(fetch_netbox, netbox.virtualization.virtual_machines, hostname, since)
+        devices = executor.submit(fetch_netbox, netbox.dcim.devices, hostname, since)
+
+        # Devices are added last, and replaces a virtual machine with same name
+        for data, is_vm in ((vms.result(), True), (devices.result(), False)):
+            for device in data:
+                #utils.pretty_print("device", device)
+                element = parse_netbox_api_response(device)
+                if element:
+                    if is_vm and device_hostnames and element.hostname in device_hostnames:
+                        continue
+                    # utils.pretty_print("element", element)
+                    elements[element.hostname] = element
+
+    if interfaces:
+        get_netbox_interfaces(netbox, elements)
+    return high_water
+
+
+def get_netbox_hostnames():
+    """
+    Get the hostname of all devices and virtual machines in NetBox, using
+    brief listings. Used to detect deleted elements in an incremental sync
+    Returns (hostnames, device hostnames), sets
+    """
+    netbox = get_netbox_api()
+    page_size = config.netbox.get("page_size", 1000)
+
+    print("----- Get names of virtual machines and elements from NetBox -----")
+    hostnames = set()
+    device_hostnames = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        vms = executor.submit(lambda: list(netbox.virtualization.virtual_machines.filter(brief=1, limit=page_size)))
+        devices = executor.submit(lambda: list(netbox.dcim.devices.filter(brief=1, limit=page_size)))
+        for vm in vms.result():
+            if vm.name:
+                hostnames.add(netbox_hostname(vm.name))
+        for device in devices.result():
+            if device.name:
+                device_hostnames.add(netbox_hostname(device.name))
+    hostnames |= device_hostnames
+    return hostnames, device_hostnames
 
 
 """
@@ -221,113 +372,73 @@ def get_from_netbox(elements, hostname=None, interfaces=False):
 """
 
 
-def store_elements_in_db(elements, interfaces=False):
+def store_elements_in_db(elements, interfaces=False, hostnames=None, high_water=None):
     """
     Get all elements (devices) from NetBox and store in
     local sqlite3 database
+    If interfaces is False, stored interfaces of the elements are kept
+    If hostnames is set, elements is only the changed elements. All elements
+    not in hostnames are then deleted, other elements are kept
+    Returns True if the database was changed
     """
     print("----- Save elements in local database -----")
-    db, cursor = common.create_db(config.sync_db, src="netbox")
+    sync_db = common.Sync_Db(config.sync_db, src="netbox",
+                             chunk_size=config.get("sync_db_chunk_size", 1000),
+                             full=hostnames is None)
+    if hostnames is not None:
+        for hostname in list(sync_db.elements):
+            if hostname not in hostnames:
+                sync_db.delete(hostname)
+    if high_water:
+        sync_db.set_high_water(high_water)
 
     for hostname, element in elements.items():
-        sql = "INSERT INTO elements ("
-        sql += "  hostname"
-        sql += " ,manufacturer"
-        sql += " ,model"
-        sql += " ,comments"
-        sql += " ,tags"
-        sql += " ,parents"
-        sql += " ,role"
-        sql += " ,site_name"
-        sql += " ,platform"
-        sql += " ,ipv4_addr"
-        sql += " ,ipv6_addr"
-        sql += " ,active"
-        sql += " ,alarm_timeperiod"
-        sql += " ,alarm_destination"
-        sql += " ,connection_method"
-        sql += " ,monitor_icinga"
-        sql += " ,monitor_librenms"
-        sql += " ,backup_oxidized"
-        sql += " ,_src"
-        sql += ") values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
-
-        cursor.execute(sql, (
-            element.hostname,
-            element.manufacturer,
-            element.model,
-            element.comments,
-            ",".join(element.tags),
-            ",".join(element.parents),
-            element.role,
-            element.site_name,
-            element.platform,
-            element.ipv4_addr,
-            element.ipv6_addr,
-            common.bool_to_int(element.active),
-            element.alarm_timeperiod,
-            ",".join(element.alarm_destination),
-            element.connection_method,
-            common.bool_to_int(element.monitor_icinga),
-            common.bool_to_int(element.monitor_librenms),
-            common.bool_to_int(element.backup_oxidized),
-            "netbox",
-            )
-        )
-
-        element_id = cursor.lastrowid
-        if interfaces:
-            # Todo, fix for netbox, below code is for BECS
-
-            # Get interfaces and their IP addresses for this element-attach
-            interface_data = self.client.service.objectTreeFind(
-                {
-                    "oid": oid,
-                    "classmask": "interface,resource-inet",
-                    "walkdown": 2,
-                } , 
-                _soapheaders = self._soapheaders
-            )
-
-            # Get IP address for each interface
-            for interface in interface_data["objects"]:
-                if interface["class"] == "interface":
-                    flags = interface["flags"]
-                    if flags is None:
-                        active = True
-                    else:
-                        active = flags.find("disable") < 0
-                    # search for the resource-inet in response
-                    prefix = None
-                    for resource_inet in interface_data["objects"]:
-                        if resource_inet["class"] == "resource-inet" and resource_inet["parentoid"] == interface["oid"]:
-                            prefix = "%s/%d" % (resource_inet["resource"]["address"], resource_inet["resource"]["prefixlen"])
-                            break
-
-                    if prefix:
-                        print("   ", interface["name"], interface["role"], prefix)
-                    cursor.execute(
-                        "INSERT INTO interfaces (elementid,name,role,ipv4_prefix,ipv6_prefix,active) values (?,?,?,?,?,?)", (
-                        element_id,
-                        interface["name"],
-                        interface["role"],
-                        prefix,
-                        "",
-                        active,
-                        )
-                    )
-    
-    cursor.execute("COMMIT")
-    cursor.close()
-    db.close()
+        sync_db.store(element, interfaces=interfaces)
+
+    sync_db.commit()
     print("Total number of elements:", len(elements))
+    sync_db.print_summary()
+    return sync_db.changed()
 
 
-def main():
+def sync(incremental=False):
+    """
+    Sync elements from NetBox to the local database
+    If incremental is True, only elements changed since last sync are fetched
+    Returns True if the database was changed
+    """
+    init_config()
+    since = None
+    if incremental:
+        since = common.get_high_water(config.sync_db, "netbox")
+        if since is None:
+            print("No previous sync, doing a full sync")
+
+    # Interface changes does not update last_updated on the device, so
+    # interfaces are only synced in a full sync
+    interfaces = config.netbox.get("interfaces", False) and not since
+
+    # In an incremental sync, the names are listed first so changed virtual
+    # machines can be skipped if a device has the same name
+    hostnames = None
+    device_hostnames = None
+    if since:
+        hostnames, device_hostnames = get_netbox_hostnames()
+
     elements = AttrDict()
-    get_from_netbox(elements)
+    high_water = get_from_netbox(elements, interfaces=interfaces, since=since,
+                                 device_hostnames=device_hostnames)
     # utils.pretty_print("elements", elements)
-    store_elements_in_db(elements)
+    return store_elements_in_db(elements, interfaces=interfaces, hostnames=hostnames, high_water=high_water)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Only fetch elements changed since last sync")
+    args = parser.parse_args()
+    sync(incremental=args.incremental)
 
 
 if __name__ == "__main__":